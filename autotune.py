@@ -0,0 +1,198 @@
+import copy
+import math
+import time
+
+import torch
+from torch import optim
+
+from checkpointing import rng_state, set_rng_state
+from evaluation import inference_mode
+from precision import FP32
+from profiling import peak_memory
+
+
+def is_oom(e):
+    return isinstance(e, RuntimeError) and 'out of memory' in str(e)
+
+
+def _sync(use_cuda):
+    if use_cuda:
+        torch.cuda.synchronize()
+
+
+def _trial(fn, batch_size, use_cuda, iters, warmup):
+    """Samples/sec and peak memory of ``fn(batch_size)``, or ``None`` if it runs out of memory."""
+    if use_cuda:
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
+    try:
+        for _ in range(warmup):
+            fn(batch_size)
+        _sync(use_cuda)
+        start = time.perf_counter()
+        for _ in range(iters):
+            fn(batch_size)
+        _sync(use_cuda)
+        seconds = time.perf_counter() - start
+    except RuntimeError as e:
+        if not is_oom(e):
+            raise
+        if use_cuda:
+            torch.cuda.empty_cache()
+        return None
+    return {'batch': batch_size, 'samples_per_sec': batch_size * iters / max(seconds, 1e-12),
+            'peak_mem_mb': peak_memory(use_cuda)}
+
+
+def _budget(use_cuda, memory_fraction):
+    """Peak memory in MB a trial may use, or ``None`` on the CPU."""
+    if not use_cuda:
+        return None
+    total = torch.cuda.get_device_properties(torch.cuda.current_device()).total_memory
+    return memory_fraction * total / 2 ** 20
+
+
+def _fits(result, budget):
+    return result is not None and (budget is None or result['peak_mem_mb'] <= budget)
+
+
+def probe(fn, use_cuda, max_batch=1024, start=1, memory_fraction=0.9, iters=3, warmup=1):
+    """Find the batch sizes ``fn`` can run and how fast each one is.
+
+    Doubles the batch from ``start`` until it runs out of memory, exceeds ``memory_fraction`` of the device
+    memory or passes ``max_batch``, then bisects between the largest fitting and the first failing size. On the
+    CPU nothing is out of memory, so only ``max_batch`` bounds the search.
+
+    Returns:
+        list of trial dicts (``batch``, ``samples_per_sec``, ``peak_mem_mb``) for the sizes that fit, by batch.
+    """
+    budget = _budget(use_cuda, memory_fraction)
+    trials = {}
+
+    def fits(b):
+        if b not in trials:
+            trials[b] = _trial(fn, b, use_cuda, iters, warmup)
+        return _fits(trials[b], budget)
+
+    low, high = None, None
+    b = start
+    while b <= max_batch:
+        if not fits(b):
+            high = b
+            break
+        low = b
+        b *= 2
+    if high is None and low is not None and low < max_batch:
+        if fits(max_batch):
+            low = max_batch
+        else:
+            high = max_batch
+    if low is not None and high is not None:
+        # stop once the gap is within 1/8 of the fitting size; a few percent of batch is not worth more probes
+        while high - low > max(1, low // 8):
+            mid = (low + high) // 2
+            if fits(mid):
+                low = mid
+            else:
+                high = mid
+    return [trials[b] for b in sorted(trials) if b <= (low or 0) and trials[b] is not None]
+
+
+def fastest(trials, limit=None):
+    """The trial with the highest samples/sec among batches up to ``limit``; ties go to the larger batch."""
+    candidates = [t for t in trials if limit is None or t['batch'] <= limit] or trials[:1]
+    assert candidates, 'Error: not even a batch of one fits in memory'
+    return max(candidates, key=lambda t: (t['samples_per_sec'], t['batch']))
+
+
+def plan_accumulation(trials, effective_batch):
+    """The fewest accumulation steps whose micro-batches fit, given the trials of the batches that fit.
+
+    The micro-batch is ``effective_batch`` split evenly into that many steps, which is what
+    ``accumulated_train_step`` runs, so it is never larger than the largest fitting batch.
+
+    Returns:
+        (micro_batch, accum_steps) with ``micro_batch * accum_steps >= effective_batch``.
+    """
+    fitting = [t['batch'] for t in trials if t['batch'] <= effective_batch]
+    assert fitting, 'Error: not even a batch of one fits in memory'
+    accum_steps = int(math.ceil(effective_batch / float(max(fitting))))
+    return int(math.ceil(effective_batch / float(accum_steps))), accum_steps
+
+
+def make_train_fn(step, denoiser, netD, target_model, bce, act, weight_adv, weight_act, use_cuda, amp=FP32,
+                  image_size=32, lr=1e-3, weight_decay=2e-4):
+    """``fn(batch_size)`` running ``step`` on random images with copies of the models and fresh optimizers."""
+    denoiser, netD = copy.deepcopy(denoiser).train(), copy.deepcopy(netD).train()
+    optimizer = optim.Adam(denoiser.parameters(), lr=lr, weight_decay=weight_decay)
+    optimizer_D = optim.Adam(netD.parameters(), lr=lr, weight_decay=weight_decay)
+    device = 'cuda' if use_cuda else 'cpu'
+
+    def fn(batch_size):
+        x = amp.prepare(torch.rand(batch_size, 3, image_size, image_size, device=device))
+        x_adv = amp.prepare(torch.rand(batch_size, 3, image_size, image_size, device=device))
+        t_real = torch.ones((batch_size, 1), device=device)
+        t_fake = torch.zeros((batch_size, 1), device=device)
+        loss = step(denoiser, netD, target_model, optimizer, optimizer_D, bce, act, x, x_adv, t_real, t_fake,
+                    weight_adv, weight_act, amp=amp)[1]
+        loss.item()
+
+    return fn
+
+
+def make_eval_fn(denoiser, target_model, use_cuda, amp=FP32, image_size=32):
+    """``fn(batch_size)`` doing what ``evaluate_loader`` does for one batch: clean and adversarial images at once."""
+    device = 'cuda' if use_cuda else 'cpu'
+
+    def fn(batch_size):
+        with inference_mode(), amp.autocast():
+            x = amp.prepare(torch.rand(2 * batch_size, 3, image_size, image_size, device=device))
+            target_model(x + denoiser(x)).float().sum().item()
+
+    return fn
+
+
+def autotune(make_train, eval_fn, effective_batch, use_cuda, max_batch=1024, memory_fraction=0.9):
+    """Pick the accumulation steps of the training batch and the batch size of the evaluation path.
+
+    ``make_train(accum_steps)`` returns ``fn(batch_size)`` running the training step that splits each batch into
+    ``accum_steps`` micro-batches; it may be ``None`` to tune evaluation only. Accumulation changes training, since
+    BatchNorm statistics and the relativistic means become per micro-batch, so it is only used when
+    ``effective_batch`` does not fit at once. Then the micro-batch probe picks the fewest steps that should fit and
+    the accumulated step itself is timed at ``effective_batch``, adding steps while it still does not fit.
+
+    The global RNG streams are restored afterwards, so tuning does not change the random sequence training sees.
+
+    Returns:
+        dict with ``micro_batch``, ``accum_steps``, ``eval_batch`` and the ``train``/``eval`` trial lists; the last
+        ``train`` trial is of the chosen step at ``effective_batch``.
+    """
+    state = rng_state()
+    try:
+        result = {'micro_batch': effective_batch, 'accum_steps': 1, 'train': []}
+        if make_train is not None:
+            budget = _budget(use_cuda, memory_fraction)
+            full = _trial(make_train(1), effective_batch, use_cuda, iters=3, warmup=1)
+            if _fits(full, budget):
+                result['train'] = [full]
+            else:
+                result['train'] = probe(make_train(1), use_cuda, max_batch=min(max_batch, effective_batch - 1),
+                                        memory_fraction=memory_fraction)
+                micro_batch, accum_steps = plan_accumulation(result['train'], effective_batch)
+                while True:
+                    trial = _trial(make_train(accum_steps), effective_batch, use_cuda, iters=3, warmup=1)
+                    if _fits(trial, budget):
+                        break
+                    assert micro_batch > 1, 'Error: not even micro-batches of one fit in memory'
+                    accum_steps += 1
+                    micro_batch = int(math.ceil(effective_batch / float(accum_steps)))
+                result['train'].append(dict(trial, accum_steps=accum_steps))
+                result['micro_batch'], result['accum_steps'] = micro_batch, accum_steps
+        # evaluation holds no autograd graph, so it can go well past the training batch
+        result['eval'] = probe(eval_fn, use_cuda, max_batch=max_batch, memory_fraction=memory_fraction)
+        result['eval_batch'] = fastest(result['eval'])['batch']
+    finally:
+        set_rng_state(state)
+        if use_cuda:
+            torch.cuda.empty_cache()
+    return result
@@ -0,0 +1,81 @@
+"""CPU latency of the purify-and-classify path in eager, TorchScript and ``torch.compile`` forms.
+
+Uses the stand-in networks, so no checkpoint is needed. Run from the repository root:
+
+    python -m benchmarks.bench_export --batch_sizes 1,2,4,8,16,32,64,128,256
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+from benchmarks.bench_scpd import git_revision
+from benchmarks.stand_ins import build_models
+from evaluation import inference_mode
+from export import FORMS, build
+
+
+def bench_form(module, batch_size, iters, warmup):
+    x = torch.rand(batch_size, 3, 32, 32)
+    latencies = []
+    with inference_mode():
+        for i in range(warmup + iters):
+            start = time.perf_counter()
+            module(x)
+            if i >= warmup:
+                latencies.append(time.perf_counter() - start)
+    lat = np.asarray(latencies)
+    return {'p50_ms': float(1e3 * np.percentile(lat, 50)), 'p99_ms': float(1e3 * np.percentile(lat, 99)),
+            'images_per_sec': float(batch_size * len(lat) / lat.sum())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Eager vs compiled purify-and-classify latency on CPU.')
+    parser.add_argument('--batch_sizes', default='1,2,4,8,16,32,64,128,256', type=str, help='comma-separated')
+    parser.add_argument('--forms', default=','.join(FORMS), type=str, help='comma-separated forms to compare')
+    parser.add_argument('--iters', default=20, type=int, help='timed calls per batch size')
+    parser.add_argument('--warmup', default=3, type=int, help='untimed calls per batch size (compiles, too)')
+    parser.add_argument('--width', default=32, type=int, help='channel width of the stand-in networks')
+    parser.add_argument('--threads', default=0, type=int, help='torch intra-op threads (0: torch default)')
+    parser.add_argument('--out', default='./bench_results', type=str, help='results directory')
+    parser.add_argument('--tag', default='', type=str, help='results file name (default: export_{git revision})')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    batch_sizes = [int(b) for b in args.batch_sizes.split(',')]
+    denoiser, _, target_model = build_models(width=args.width)
+    denoiser.eval()
+
+    results = {}
+    for form in args.forms.split(','):
+        try:
+            module = build(denoiser, target_model, form, example=torch.rand(batch_sizes[0], 3, 32, 32))
+            results[form] = {str(b): bench_form(module, b, args.iters, args.warmup) for b in batch_sizes}
+        except Exception as e:  # e.g. torch.compile without a working C++ toolchain
+            print('{}: skipped ({}: {})'.format(form, type(e).__name__, e))
+
+    forms = list(results)
+    print('{:>6}'.format('batch') + ''.join('{:>16}'.format(f + ' p50ms') for f in forms) +
+          ''.join('{:>16}'.format(f + ' x') for f in forms if f != 'eager'))
+    for b in map(str, batch_sizes):
+        row = '{:>6}'.format(b) + ''.join('{:>16.2f}'.format(results[f][b]['p50_ms']) for f in forms)
+        if 'eager' in results:
+            row += ''.join('{:>16.2f}'.format(results['eager'][b]['p50_ms'] / results[f][b]['p50_ms'])
+                           for f in forms if f != 'eager')
+        print(row)
+
+    meta = {'revision': git_revision(), 'torch': torch.__version__, 'threads': torch.get_num_threads(),
+            'width': args.width, 'iters': args.iters, 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, '{}.json'.format(args.tag or 'export_' + meta['revision']))
+    with open(path, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2)
+    print('results saved to ' + path)
+
+
+if __name__ == '__main__':
+    main()
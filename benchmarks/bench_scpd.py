@@ -0,0 +1,249 @@
+"""CPU throughput benchmarks for the SCPD data, train, test and evaluate paths.
+
+Runs on synthetic data in the ``DatasetNPY_Dual`` layout with stand-in networks, so no saved data,
+target checkpoint or GPU is needed. The train, test and evaluate benchmarks drive ``Experiment.train``,
+``Experiment.test`` and ``Experiment.evaluate`` with the stand-ins in place of its networks. Run from the
+repository root:
+
+    python -m benchmarks.bench_scpd --tag baseline
+    python -m benchmarks.bench_scpd --tag candidate --compare bench_results/baseline.json
+
+Each benchmark runs in its own interpreter, so its peak RSS is not the high-water mark of the ones before it.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from torchvision import transforms
+
+from benchmarks.stand_ins import StandInACT, build_models, make_dual_dataset
+from dataload_packed import DatasetPacked_Dual, pack_dual, packed_loader
+from scpd import Experiment, parse_args
+from train_step import fuse_bn_momentum
+
+
+def timed(loader, latencies, limit=None):
+    """Yield from ``loader``, appending the wall time of every iteration (loading plus loop body)."""
+    last = time.perf_counter()
+    for i, batch in enumerate(loader):
+        if limit is not None and i >= limit:
+            break
+        yield batch
+        now = time.perf_counter()
+        latencies.append(now - last)
+        last = now
+
+
+class TimedLoader(object):
+    """``loader`` iterated through ``timed``, keeping its length and attributes, to replace an ``Experiment`` loader."""
+
+    def __init__(self, loader, latencies, limit=None):
+        self.loader = loader
+        self.latencies = latencies
+        self.limit = limit
+
+    def __len__(self):
+        return len(self.loader) if self.limit is None else min(len(self.loader), self.limit)
+
+    def __iter__(self):
+        return timed(self.loader, self.latencies, self.limit)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+
+def summarize(latencies, batch_size, warmup):
+    lat = np.asarray(latencies[warmup:] if len(latencies) > warmup else latencies)
+    return {'batches': int(len(lat)),
+            'samples_per_sec': float(batch_size * len(lat) / lat.sum()) if lat.sum() > 0 else 0.0,
+            'p50_ms': float(1e3 * np.percentile(lat, 50)),
+            'p90_ms': float(1e3 * np.percentile(lat, 90)),
+            'p99_ms': float(1e3 * np.percentile(lat, 99)),
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def make_experiment(args, out_dir, fused=False):
+    """An ``Experiment`` on the CPU whose networks and losses are the stand-ins, with its outputs under ``out_dir``.
+
+    The stand-ins pre-seed the lazy attributes, so ``train``, ``test`` and ``evaluate`` run unchanged without
+    loading a target checkpoint; the benchmarks pre-seed the loaders the same way.
+    """
+    exp = Experiment(parse_args(['--batch_size', str(args.batch_size), '--fused_step', str(int(fused)),
+                                 '--gpu', os.environ.get('CUDA_VISIBLE_DEVICES', '')]))
+    exp.use_cuda = False
+    exp.args.grid_img = os.path.join(out_dir, 'grid_img')
+    exp.args.save_dir = exp.save_dir = os.path.join(out_dir, 'checkpoint')
+    os.makedirs(exp.args.grid_img)
+    denoiser, netD, target_model = build_models(width=args.width)
+    exp.denoiser, exp.netD, exp.target_model = exp._place(denoiser), exp._place(netD), exp._place(target_model)
+    exp.ACT_stable = StandInACT(exp.target_model)
+    return exp
+
+
+def bench_load(loader, args):
+    latencies = []
+    for _ in timed(loader, latencies, args.iters):
+        pass
+    return summarize(latencies, args.batch_size, args.warmup)
+
+
+def bench_train(loader, fused, args):
+    latencies = []
+    with tempfile.TemporaryDirectory() as tmp:
+        exp = make_experiment(args, tmp, fused=fused)
+        if fused:
+            # as fit() does before the first fused epoch
+            fuse_bn_momentum(exp.denoiser)
+        exp.train_loader = TimedLoader(loader, latencies, args.iters)
+        exp.train(1)
+    return summarize(latencies, args.batch_size, args.warmup)
+
+
+def bench_test(loader, args):
+    latencies = []
+    with tempfile.TemporaryDirectory() as tmp:
+        exp = make_experiment(args, tmp)
+        try:
+            exp.test(1, TimedLoader(loader, latencies, args.iters))
+        finally:
+            exp.snapshotter.close()
+    return summarize(latencies, args.batch_size, args.warmup)
+
+
+def bench_evaluate(loader, args):
+    latencies = []
+    with tempfile.TemporaryDirectory() as tmp:
+        exp = make_experiment(args, tmp)
+        path = os.path.join(tmp, 'denoiser.pth')
+        torch.save(exp.denoiser.state_dict(), path)
+        exp.test_loader = TimedLoader(loader, latencies, args.iters)
+        with contextlib.redirect_stdout(io.StringIO()):
+            exp.evaluate(path, os.path.join(tmp, 'denoised'))
+    return summarize(latencies, args.batch_size, args.warmup)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+    print('{:<24}{:>14}{:>14}{:>9}'.format('benchmark', 'base/s', 'new/s', 'ratio'))
+    for name, res in results.items():
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['samples_per_sec'], res['samples_per_sec']
+        print('{:<24}{:>14.1f}{:>14.1f}{:>9.2f}'.format(name, old, new, new / old if old else float('nan')))
+
+
+def main():
+    from dataload import DatasetNPY_Dual
+
+    parser = argparse.ArgumentParser(description='SCPD CPU benchmarks on synthetic data.')
+    parser.add_argument('--data_root', default='./bench_data', type=str, help='where synthetic data is generated')
+    parser.add_argument('--samples', default=2000, type=int, help='synthetic dataset size')
+    parser.add_argument('--batch_size', default=200, type=int, help='batch size')
+    parser.add_argument('--width', default=32, type=int, help='channel width of the stand-in networks')
+    parser.add_argument('--iters', default=None, type=int, help='max batches per benchmark (default: one epoch)')
+    parser.add_argument('--warmup', default=2, type=int, help='batches excluded from the statistics')
+    parser.add_argument('--threads', default=0, type=int, help='torch intra-op threads (0: torch default)')
+    parser.add_argument('--only', default='', type=str, help='comma-separated benchmark names to run')
+    parser.add_argument('--out', default='./bench_results', type=str, help='results directory')
+    parser.add_argument('--tag', default='', type=str, help='results file name (default: git revision)')
+    parser.add_argument('--compare', default='', type=str, help='results file to compare against')
+    parser.add_argument('--isolate', default=1, type=int, help='run every benchmark in a fresh interpreter')
+    parser.add_argument('--result_file', default='', type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    cln_dir, adv_dir, label_path = make_dual_dataset(os.path.join(args.data_root, 'npy'), args.samples)
+    npy_data = DatasetNPY_Dual(imgcln_dirs=cln_dir, imgadv_dirs=adv_dir, label_dirs=label_path,
+                               transform=transforms.ToTensor())
+    packed_root = os.path.join(args.data_root, 'packed')
+    if not os.path.isfile(os.path.join(packed_root, 'adv.npy')):
+        pack_dual(npy_data, packed_root, packed_root, num_workers=0)
+    packed_data = DatasetPacked_Dual(packed_root, packed_root)
+
+    def npy_loader(shuffle):
+        return DataLoader(npy_data, batch_size=args.batch_size, shuffle=shuffle, drop_last=False)
+
+    def packed(shuffle):
+        return packed_loader(packed_data, batch_size=args.batch_size, shuffle=shuffle, drop_last=False)
+
+    benchmarks = [
+        ('load_npy', lambda: bench_load(npy_loader(True), args)),
+        ('load_packed', lambda: bench_load(packed(True), args)),
+        ('train_reference', lambda: bench_train(packed(True), False, args)),
+        ('train_fused', lambda: bench_train(packed(True), True, args)),
+        ('test', lambda: bench_test(packed(False), args)),
+        ('evaluate', lambda: bench_evaluate(packed(False), args)),
+    ]
+    only = set(filter(None, args.only.split(',')))
+
+    if args.result_file:
+        # one benchmark of an isolated run; the increase leaves out the interpreter, torch and the data setup
+        name, run = next(b for b in benchmarks if b[0] in only)
+        before = peak_rss_mb()
+        result = run()
+        result['rss_increase_mb'] = result['peak_rss_mb'] - before
+        with open(args.result_file, 'w') as f:
+            json.dump(result, f)
+        return
+
+    results = {}
+    for name, run in benchmarks:
+        if only and name not in only:
+            continue
+        if args.isolate:
+            with tempfile.TemporaryDirectory() as tmp:
+                result_file = os.path.join(tmp, 'result.json')
+                subprocess.run([sys.executable, '-m', 'benchmarks.bench_scpd'] + sys.argv[1:] +
+                               ['--only', name, '--result_file', result_file], check=True)
+                with open(result_file) as f:
+                    results[name] = json.load(f)
+        else:
+            before = peak_rss_mb()
+            results[name] = run()
+            results[name]['rss_increase_mb'] = results[name]['peak_rss_mb'] - before
+        print('{:<24}{samples_per_sec:>10.1f} samples/s  p50 {p50_ms:.1f}ms  p99 {p99_ms:.1f}ms  '
+              'peak RSS {peak_rss_mb:.0f}MB (+{rss_increase_mb:.0f}MB)'.format(name, **results[name]))
+
+    revision = git_revision()
+    meta = {'revision': revision, 'torch': torch.__version__, 'python': platform.python_version(),
+            'machine': platform.machine(), 'threads': torch.get_num_threads(), 'samples': args.samples,
+            'batch_size': args.batch_size, 'width': args.width, 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, '{}.json'.format(args.tag or revision))
+    with open(path, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2)
+    print('results saved to ' + path)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Load generator for the purification server in ``serving.py``.
+
+By default it serves stand-in networks in-process, so no checkpoint is needed; ``--url`` drives a running
+server over HTTP instead. ``--clients`` threads each send ``--requests`` requests of ``--images`` images back to
+back. Run from the repository root:
+
+    python -m benchmarks.bench_serving --clients 32 --max_batch 64 --max_latency_ms 5
+    python -m benchmarks.bench_serving --url http://127.0.0.1:8000 --clients 32
+"""
+import argparse
+import io
+import json
+import os
+import threading
+import time
+from urllib.request import Request, urlopen
+
+import numpy as np
+import torch
+
+from benchmarks.bench_scpd import git_revision
+from benchmarks.stand_ins import build_models
+from serving import DynamicBatcher
+
+
+def run_clients(send, clients, requests, make_input):
+    """Run ``clients`` closed-loop threads and return per-request latencies in seconds and the wall time."""
+    latencies = [[] for _ in range(clients)]
+    errors = []
+
+    def client(k):
+        x = make_input(k)
+        try:
+            for _ in range(requests):
+                start = time.perf_counter()
+                send(x)
+                latencies[k].append(time.perf_counter() - start)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=client, args=(k,)) for k in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+    if errors:
+        raise errors[0]
+    return [v for lat in latencies for v in lat], wall
+
+
+def http_sender(url, outputs):
+    endpoint = url.rstrip('/') + ('/classify' if outputs == 'logits' else '/purify')
+
+    def send(x):
+        buf = io.BytesIO()
+        np.save(buf, x)
+        with urlopen(Request(endpoint, data=buf.getvalue(), method='POST')) as r:
+            return np.load(io.BytesIO(r.read()))
+
+    return send
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Latency and throughput of the SCPD purification server.')
+    parser.add_argument('--url', default='', type=str, help='running server to load (default: in-process)')
+    parser.add_argument('--clients', default=16, type=int, help='concurrent closed-loop clients')
+    parser.add_argument('--requests', default=50, type=int, help='requests per client')
+    parser.add_argument('--images', default=1, type=int, help='images per request')
+    parser.add_argument('--outputs', default='logits', type=str, help='what to request = [logits/images]')
+    parser.add_argument('--max_batch', default=64, type=int, help='in-process micro-batch size')
+    parser.add_argument('--max_latency_ms', default=5.0, type=float, help='in-process batching delay')
+    parser.add_argument('--width', default=32, type=int, help='channel width of the stand-in networks')
+    parser.add_argument('--threads', default=0, type=int, help='torch intra-op threads (0: torch default)')
+    parser.add_argument('--out', default='./bench_results', type=str, help='results directory')
+    parser.add_argument('--tag', default='', type=str, help='results file name (default: serving_{git revision})')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    rng = np.random.RandomState(0)
+
+    def make_input(k):
+        return rng.randint(0, 256, size=(args.images, 32, 32, 3)).astype(np.uint8)
+
+    batcher = None
+    if args.url:
+        send = http_sender(args.url, args.outputs)
+    else:
+        denoiser, _, target_model = build_models(width=args.width)
+        batcher = DynamicBatcher(denoiser.eval(), target_model, max_batch_size=args.max_batch,
+                                 max_latency_ms=args.max_latency_ms)
+
+        def send(x):
+            return batcher(torch.from_numpy(x.transpose(0, 3, 1, 2).copy()).float().div_(255), args.outputs)
+
+    try:
+        latencies, wall = run_clients(send, args.clients, args.requests, make_input)
+    finally:
+        if batcher is not None:
+            batcher.close()
+
+    lat = np.asarray(latencies)
+    result = {'requests': int(len(lat)), 'requests_per_sec': float(len(lat) / wall),
+              'images_per_sec': float(len(lat) * args.images / wall),
+              'p50_ms': float(1e3 * np.percentile(lat, 50)), 'p99_ms': float(1e3 * np.percentile(lat, 99)),
+              'mean_batch': batcher.stats()['mean_batch'] if batcher is not None else None}
+    print('{requests_per_sec:.1f} requests/s  {images_per_sec:.1f} images/s  p50 {p50_ms:.1f}ms  '
+          'p99 {p99_ms:.1f}ms'.format(**result) +
+          ('  mean batch {:.1f}'.format(result['mean_batch']) if result['mean_batch'] is not None else ''))
+
+    meta = {'revision': git_revision(), 'torch': torch.__version__, 'url': args.url, 'clients': args.clients,
+            'requests': args.requests, 'images': args.images, 'max_batch': args.max_batch,
+            'max_latency_ms': args.max_latency_ms, 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, '{}.json'.format(args.tag or 'serving_' + meta['revision']))
+    with open(path, 'w') as f:
+        json.dump({'meta': meta, 'results': {'serving': result}}, f, indent=2)
+    print('results saved to ' + path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Startup time of the SCPD entry points, each in a fresh interpreter.
+
+``import`` times ``import scpd``, ``help`` runs ``python main.py --help`` and ``experiment`` constructs an
+``Experiment`` for TEST mode without touching its data or networks. Run from the repository root:
+
+    python -m benchmarks.bench_startup --runs 10
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import torch
+
+from benchmarks.bench_scpd import git_revision
+
+CASES = {
+    'import': [sys.executable, '-c', 'import scpd'],
+    'help': [sys.executable, 'main.py', '--help'],
+    'experiment': [sys.executable, '-c', "from scpd import Experiment, parse_args; "
+                                         "Experiment(parse_args(['--mode', '1']))"],
+}
+
+
+def time_case(cmd, runs):
+    seconds = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Wall-clock startup time of the SCPD entry points.')
+    parser.add_argument('--cases', default=','.join(CASES), type=str, help='comma-separated cases to time')
+    parser.add_argument('--runs', default=10, type=int, help='fresh interpreters per case')
+    parser.add_argument('--out', default='./bench_results', type=str, help='results directory')
+    parser.add_argument('--tag', default='', type=str, help='results file name (default: startup_{git revision})')
+    args = parser.parse_args()
+
+    # a warm page cache for the interpreter and torch, as on any run after the first
+    subprocess.run([sys.executable, '-c', 'import torch'], check=True)
+
+    results = {}
+    print('{:<12}{:>10}{:>10}{:>10}'.format('case', 'median s', 'p90 s', 'min s'))
+    for case in args.cases.split(','):
+        seconds = np.asarray(time_case(CASES[case], args.runs))
+        results[case] = {'median_s': float(np.median(seconds)), 'p90_s': float(np.percentile(seconds, 90)),
+                         'min_s': float(seconds.min()), 'runs': seconds.tolist()}
+        print('{:<12}{median_s:>10.3f}{p90_s:>10.3f}{min_s:>10.3f}'.format(case, **results[case]))
+
+    meta = {'revision': git_revision(), 'torch': torch.__version__, 'python': sys.version.split()[0],
+            'runs': args.runs, 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, '{}.json'.format(args.tag or 'startup_' + meta['revision']))
+    with open(path, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2)
+    print('results saved to ' + path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Load time and memory of a pickled ``.t7`` target model against its weight-only conversion.
+
+Saves a stand-in target model both ways, then loads each in fresh interpreters and reports the wall-clock time to
+a usable network, the time of its first forward pass, and the resident memory added by the load and after the
+forward pass (read from ``/proc/self/status``, so Linux only). Mapped pages only become resident once a forward pass
+reads them. Run from the repository root:
+
+    python -m benchmarks.bench_weights --width 512 --runs 5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import torch
+
+from benchmarks.bench_scpd import git_revision
+from benchmarks.stand_ins import StandInTarget
+from weights import save_weights
+
+CHILD = '''
+import json, sys, time
+import torch
+
+
+def rss_mb():
+    with open('/proc/self/status') as f:
+        return next(int(line.split()[1]) for line in f if line.startswith('VmRSS')) / 1024.0
+
+
+from checkpointing import load_pickled
+from weights import load_module
+before = rss_mb()
+start = time.perf_counter()
+if sys.argv[1] == 'pickle':
+    net = load_pickled(sys.argv[2])['net'].eval()
+else:
+    net = load_module(sys.argv[2])
+loaded = time.perf_counter()
+loaded_rss = rss_mb() - before
+with torch.no_grad():
+    net(torch.rand(1, 3, 32, 32))
+print(json.dumps({'load_s': loaded - start, 'first_forward_s': time.perf_counter() - loaded,
+                  'load_rss_mb': loaded_rss, 'rss_mb': rss_mb() - before}))
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pickled vs weight-only target model loading.')
+    parser.add_argument('--width', default=512, type=int, help='channel width of the stand-in target model')
+    parser.add_argument('--runs', default=5, type=int, help='fresh interpreters per format')
+    parser.add_argument('--data', default='./bench_data/weights', type=str, help='where the checkpoints are written')
+    parser.add_argument('--out', default='./bench_results', type=str, help='results directory')
+    parser.add_argument('--tag', default='', type=str, help='results file name (default: weights_{git revision})')
+    args = parser.parse_args()
+
+    os.makedirs(args.data, exist_ok=True)
+    net = StandInTarget(width=args.width).eval()
+    paths = {'pickle': os.path.join(args.data, 'target_w{}.t7'.format(args.width)),
+             'weights': os.path.join(args.data, 'target_w{}.weights'.format(args.width))}
+    torch.save({'net': net}, paths['pickle'])
+    save_weights(net.state_dict(), paths['weights'], 'benchmarks.stand_ins.StandInTarget',
+                 {'width': args.width})
+    size_mb = sum(t.numel() * t.element_size() for t in net.state_dict().values()) / 2 ** 20
+
+    results = {}
+    print('{:<10}{:>12}{:>18}{:>14}{:>12}'.format('format', 'load ms', 'first fwd ms', 'load RSS MB', 'RSS MB'))
+    for fmt, path in paths.items():
+        runs = [json.loads(subprocess.run([sys.executable, '-c', CHILD, fmt, path], check=True,
+                                          stdout=subprocess.PIPE).stdout) for _ in range(args.runs)]
+        results[fmt] = {k: float(np.median([r[k] for r in runs])) for k in runs[0]}
+        print('{:<10}{:>12.2f}{:>18.2f}{:>14.1f}{:>12.1f}'.format(fmt, 1e3 * results[fmt]['load_s'],
+                                                                  1e3 * results[fmt]['first_forward_s'],
+                                                                  results[fmt]['load_rss_mb'], results[fmt]['rss_mb']))
+
+    meta = {'revision': git_revision(), 'torch': torch.__version__, 'width': args.width, 'weights_mb': size_mb,
+            'runs': args.runs, 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, '{}.json'.format(args.tag or 'weights_' + meta['revision']))
+    with open(path, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2)
+    print('results saved to ' + path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Synthetic data in the ``DatasetNPY_Dual`` layout and small stand-ins for the SCPD networks."""
+import os
+import pickle
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def make_dual_dataset(root, num_samples, image_size=32, num_classes=10, seed=0):
+    """Write ``num_samples`` random clean/adversarial pairs under ``root`` like ``saved_data_logits`` does.
+
+    Layout: ``root/clean/npy/{i}.npy`` and ``root/adv/npy/{i}.npy`` hold HxWx3 uint8 images and
+    ``root/label_true.pkl`` the list of labels. Existing data of the same size is reused.
+
+    Returns:
+        (clean dir, adversarial dir, label path)
+    """
+    cln_dir = os.path.join(root, 'clean', 'npy')
+    adv_dir = os.path.join(root, 'adv', 'npy')
+    label_path = os.path.join(root, 'label_true.pkl')
+    if os.path.isfile(label_path) and len(os.listdir(cln_dir)) == num_samples:
+        return cln_dir, adv_dir, label_path
+
+    os.makedirs(cln_dir, exist_ok=True)
+    os.makedirs(adv_dir, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    for i in range(num_samples):
+        cln = rng.randint(0, 256, size=(image_size, image_size, 3)).astype(np.uint8)
+        adv = np.clip(cln.astype(np.int16) + rng.randint(-8, 9, size=cln.shape), 0, 255).astype(np.uint8)
+        np.save(os.path.join(cln_dir, '{}.npy'.format(i)), cln)
+        np.save(os.path.join(adv_dir, '{}.npy'.format(i)), adv)
+    with open(label_path, 'wb') as f:
+        pickle.dump([int(v) for v in rng.randint(0, num_classes, size=num_samples)], f)
+    return cln_dir, adv_dir, label_path
+
+
+class StandInDenoiser(nn.Module):
+    """Residual conv net predicting the noise that ``x + denoiser(x)`` removes, like ``Denoiser``."""
+
+    def __init__(self, width=32):
+        super(StandInDenoiser, self).__init__()
+        self.body = nn.Sequential(
+            nn.Conv2d(3, width, 3, padding=1), nn.BatchNorm2d(width), nn.ReLU(inplace=True),
+            nn.Conv2d(width, width, 3, padding=1), nn.BatchNorm2d(width), nn.ReLU(inplace=True),
+            nn.Conv2d(width, 3, 3, padding=1))
+
+    def forward(self, x):
+        return self.body(x)
+
+
+class StandInDiscriminator(nn.Module):
+    """Strided conv net returning one logit per image, like ``Discriminator(3, 32)``."""
+
+    def __init__(self, width=32):
+        super(StandInDiscriminator, self).__init__()
+        self.body = nn.Sequential(
+            nn.Conv2d(3, width, 4, stride=2, padding=1), nn.LeakyReLU(0.2, inplace=True),
+            nn.Conv2d(width, 2 * width, 4, stride=2, padding=1), nn.BatchNorm2d(2 * width),
+            nn.LeakyReLU(0.2, inplace=True),
+            nn.AdaptiveAvgPool2d(1), nn.Flatten(), nn.Linear(2 * width, 1))
+
+    def forward(self, x):
+        return self.body(x)
+
+
+class StandInTarget(nn.Module):
+    """Small VGG-style classifier standing in for the ``.t7`` target model."""
+
+    def __init__(self, num_classes=10, width=32):
+        super(StandInTarget, self).__init__()
+        self.features = nn.Sequential(
+            nn.Conv2d(3, width, 3, padding=1), nn.BatchNorm2d(width), nn.ReLU(inplace=True), nn.MaxPool2d(2),
+            nn.Conv2d(width, 2 * width, 3, padding=1), nn.BatchNorm2d(2 * width), nn.ReLU(inplace=True),
+            nn.MaxPool2d(2), nn.AdaptiveAvgPool2d(1), nn.Flatten())
+        self.classifier = nn.Linear(2 * width, num_classes)
+
+    def forward(self, x):
+        return self.classifier(self.features(x))
+
+
+class StandInACT(nn.Module):
+    """Logit-matching loss standing in for ``logits_criteria(Logits_tensor(target_model))``."""
+
+    def __init__(self, target_model):
+        super(StandInACT, self).__init__()
+        self.target_model = target_model
+
+    def forward(self, x_smooth, x):
+        with torch.no_grad():
+            clean = self.target_model(x)
+        return F.mse_loss(self.target_model(x_smooth), clean)
+
+
+def build_models(num_classes=10, width=32, seed=0):
+    torch.manual_seed(seed)
+    return StandInDenoiser(width), StandInDiscriminator(width), StandInTarget(num_classes, width).eval()
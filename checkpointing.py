@@ -0,0 +1,120 @@
+import os
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+
+def to_cpu(obj):
+    """Copy every tensor in a (nested) state dict to the CPU, so later training steps cannot change it."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def strip_prefix(state_dict, prefix='module.'):
+    """Drop the ``DataParallel`` prefix that ``main.py`` checkpoints carry when saved from wrapped models."""
+    return type(state_dict)((k[len(prefix):] if k.startswith(prefix) else k, v) for k, v in state_dict.items())
+
+
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def training_state(denoiser, netD, optimizer, optimizer_D, epoch, best_acc, **extra):
+    """CPU snapshot of everything needed to continue training after ``epoch``."""
+    state = {'denoiser': denoiser.state_dict(), 'netD': netD.state_dict(),
+             'optimizer': optimizer.state_dict(), 'optimizer_D': optimizer_D.state_dict()}
+    state = to_cpu(state)
+    state.update(epoch=epoch, best_acc=best_acc, rng=rng_state(), **extra)
+    return state
+
+
+def load_pickled(path):
+    """``torch.load`` to the CPU for trusted checkpoints holding whole pickled objects, like the ``.t7`` models."""
+    try:
+        return torch.load(path, map_location='cpu', weights_only=False)
+    except TypeError:  # PyTorch < 1.13 has no weights_only and never restricts unpickling
+        return torch.load(path, map_location='cpu')
+
+
+def load_training_state(path, denoiser, netD, optimizer, optimizer_D):
+    """Restore a ``training_state`` checkpoint in place, including the RNG streams.
+
+    Returns:
+        the checkpoint dict, whose ``epoch`` is the last finished epoch.
+    """
+    state = load_pickled(path)
+    denoiser.load_state_dict(state['denoiser'])
+    netD.load_state_dict(state['netD'])
+    optimizer.load_state_dict(state['optimizer'])
+    optimizer_D.load_state_dict(state['optimizer_D'])
+    set_rng_state(state['rng'])
+    return state
+
+
+class AsyncCheckpointer(object):
+    """Writes checkpoints with ``torch.save`` from a background thread.
+
+    Each file is written to ``path + '.tmp'`` and renamed into place, so a crash mid-write never leaves a
+    truncated checkpoint. Only ``max_pending`` saves may wait; ``save`` blocks beyond that instead of
+    piling CPU snapshots up in memory.
+    """
+
+    def __init__(self, max_pending=2):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def save(self, state, path):
+        """Queue ``state`` for writing; it must already be a CPU snapshot (see ``to_cpu``)."""
+        if self.error is not None:
+            raise self.error
+        self.queue.put((state, path))
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                state, path = item
+                directory = os.path.dirname(path)
+                if directory and not os.path.exists(directory):
+                    os.makedirs(directory, exist_ok=True)
+                torch.save(state, path + '.tmp')
+                os.replace(path + '.tmp', path)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def wait(self):
+        """Block until every queued checkpoint is on disk."""
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,151 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import BatchSampler, DataLoader, Dataset, RandomSampler, SequentialSampler
+
+CLEAN_FILE = 'clean.npy'
+ADV_FILE = 'adv.npy'
+LABEL_FILE = 'label.npy'
+META_FILE = 'meta.json'
+
+
+def _to_uint8(t):
+    # inverse of ToTensor for uint8 sources: x / 255 * 255 rounds back to the original byte
+    return t.mul(255).add_(0.5).clamp_(0, 255).to(torch.uint8).numpy()
+
+
+def _read_meta(root):
+    path = os.path.join(root, META_FILE)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_meta(root, meta):
+    with open(os.path.join(root, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+def pack_dual(dataset, out_cln, out_adv, batch_size=500, num_workers=4, overwrite=False):
+    """Pack a ``DatasetNPY_Dual`` into contiguous uint8 shards.
+
+    Clean images and labels go to ``out_cln``, adversarial images to ``out_adv``, so test sets of
+    several attacks can share one clean shard. The clean shard is only rewritten when it is missing,
+    has a different length or ``overwrite`` is set.
+
+    Args:
+        dataset (Dataset): yields ``(x, x_adv, y)`` with images as float tensors in ``[0, 1]``.
+        out_cln (str): directory for ``clean.npy`` and ``label.npy``.
+        out_adv (str): directory for ``adv.npy``.
+    """
+    n = len(dataset)
+    x0, _, _ = dataset[0]
+    shape = (n,) + tuple(x0.shape)
+
+    meta = _read_meta(out_cln)
+    write_cln = overwrite or meta is None or meta.get('length') != n
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, drop_last=False, num_workers=num_workers)
+
+    os.makedirs(out_adv, exist_ok=True)
+    adv = np.lib.format.open_memmap(os.path.join(out_adv, ADV_FILE), mode='w+', dtype=np.uint8, shape=shape)
+    if write_cln:
+        os.makedirs(out_cln, exist_ok=True)
+        cln = np.lib.format.open_memmap(os.path.join(out_cln, CLEAN_FILE), mode='w+', dtype=np.uint8, shape=shape)
+        label = np.lib.format.open_memmap(os.path.join(out_cln, LABEL_FILE), mode='w+', dtype=np.int64, shape=(n,))
+
+    start = 0
+    for x, x_adv, y in loader:
+        stop = start + x.size(0)
+        adv[start:stop] = _to_uint8(x_adv)
+        if write_cln:
+            cln[start:stop] = _to_uint8(x)
+            label[start:stop] = torch.as_tensor(y).numpy()
+        start = stop
+
+    adv.flush()
+    _write_meta(out_adv, {'length': n, 'shape': list(shape[1:])})
+    if write_cln:
+        cln.flush()
+        label.flush()
+        _write_meta(out_cln, {'length': n, 'shape': list(shape[1:])})
+
+
+def batch_index(indices):
+    """Turn a sample index or a batch of indices into the cheapest equivalent numpy index.
+
+    Batches are sorted for locality; a run of consecutive indices becomes a slice (a view of the memory map).
+    """
+    if isinstance(indices, (int, np.integer)):
+        return int(indices)
+    indices = np.sort(np.asarray(indices, dtype=np.int64))
+    if len(indices) and indices[-1] - indices[0] + 1 == len(indices):
+        return slice(int(indices[0]), int(indices[-1]) + 1)
+    return indices
+
+
+class DatasetPacked_Dual(Dataset):
+    """Memory-mapped counterpart of ``DatasetNPY_Dual`` reading shards written by ``pack_dual``.
+
+    Indexing with an int returns one sample like ``DatasetNPY_Dual`` does. Indexing with a list of
+    indices returns a whole batch: consecutive indices are served by slicing the memory map, other
+    index sets by a single gather, so one batch costs one read per array instead of one file per sample.
+    """
+
+    def __init__(self, cln_dirs, adv_dirs):
+        self.cln = np.load(os.path.join(cln_dirs, CLEAN_FILE), mmap_mode='c')
+        self.adv = np.load(os.path.join(adv_dirs, ADV_FILE), mmap_mode='c')
+        self.label = np.load(os.path.join(cln_dirs, LABEL_FILE), mmap_mode='c')
+        assert len(self.cln) == len(self.adv) == len(self.label), \
+            'Error: clean shard {} and adversarial shard {} differ in length'.format(cln_dirs, adv_dirs)
+
+    def __len__(self):
+        return len(self.label)
+
+    def __getitem__(self, indices):
+        idx = batch_index(indices)
+        x = torch.from_numpy(self.cln[idx]).float().div_(255)
+        x_adv = torch.from_numpy(self.adv[idx]).float().div_(255)
+        y = torch.from_numpy(np.asarray(self.label[idx]))
+        return x, x_adv, y
+
+
+def packed_loader(dataset, batch_size, shuffle=False, drop_last=False, num_workers=0, sampler=None):
+    """Loader that asks ``DatasetPacked_Dual`` for whole batches instead of collating samples.
+
+    ``sampler`` replaces the random or sequential sample order, e.g. with a ``DistributedSampler``.
+    """
+    if sampler is None:
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last), batch_size=None,
+                      num_workers=num_workers)
+
+
+def main():
+    from torchvision import transforms
+
+    from dataload import DatasetNPY_Dual
+
+    parser = argparse.ArgumentParser(description='Pack DatasetNPY_Dual directories into memory-mapped shards.')
+    parser.add_argument('--cln', required=True, type=str, help='directory of clean .npy images')
+    parser.add_argument('--adv', required=True, type=str, help='directory of adversarial .npy images')
+    parser.add_argument('--label', required=True, type=str, help='path of label_true.pkl')
+    parser.add_argument('--out_cln', required=True, type=str, help='output directory of clean shard and labels')
+    parser.add_argument('--out_adv', required=True, type=str, help='output directory of adversarial shard')
+    parser.add_argument('--batch_size', default=500, type=int, help='packing batch size')
+    parser.add_argument('--workers', default=4, type=int, help='loader workers used while packing')
+    parser.add_argument('--overwrite', default=0, type=int, help='rewrite an existing clean shard')
+    args = parser.parse_args()
+
+    data = DatasetNPY_Dual(imgcln_dirs=args.cln, imgadv_dirs=args.adv, label_dirs=args.label,
+                           transform=transforms.ToTensor())
+    pack_dual(data, args.out_cln, args.out_adv, batch_size=args.batch_size, num_workers=args.workers,
+              overwrite=bool(args.overwrite))
+    print('packed {} samples into {} and {}'.format(len(data), args.out_cln, args.out_adv))
+
+
+if __name__ == '__main__':
+    main()
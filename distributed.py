@@ -0,0 +1,60 @@
+import os
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+
+def init_distributed(backend='nccl'):
+    """Join the process group described by the ``torchrun`` environment variables.
+
+    Returns:
+        (rank, world_size, local_rank)
+    """
+    rank = int(os.environ['RANK'])
+    world_size = int(os.environ['WORLD_SIZE'])
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if backend == 'nccl':
+        torch.cuda.set_device(local_rank)
+    dist.init_process_group(backend=backend, init_method='env://')
+    return rank, world_size, local_rank
+
+
+def is_main_process():
+    return not dist.is_available() or not dist.is_initialized() or dist.get_rank() == 0
+
+
+def barrier():
+    if dist.is_available() and dist.is_initialized():
+        dist.barrier()
+
+
+def unwrap(module):
+    """The network inside a ``DistributedDataParallel``/``DataParallel`` wrapper."""
+    return module.module if hasattr(module, 'module') else module
+
+
+class ShardSampler(Sampler):
+    """Deterministic ``rank::world_size`` split for evaluation.
+
+    Unlike ``DistributedSampler`` it does not pad shards to equal length, so every sample is scored exactly once.
+    """
+
+    def __init__(self, dataset, rank=None, world_size=None):
+        self.rank = dist.get_rank() if rank is None else rank
+        self.world_size = dist.get_world_size() if world_size is None else world_size
+        self.indices = list(range(len(dataset)))[self.rank::self.world_size]
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+def set_sampler_epoch(loader, epoch):
+    """Reshuffle a ``DistributedSampler`` for ``epoch``, also when ``packed_loader`` wraps it in a ``BatchSampler``."""
+    sampler = loader.sampler
+    sampler = getattr(sampler, 'sampler', sampler)
+    if hasattr(sampler, 'set_epoch'):
+        sampler.set_epoch(epoch)
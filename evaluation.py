@@ -0,0 +1,102 @@
+import time
+
+import torch
+
+from meters import DeviceMeter
+from precision import FP32, MODES, Precision
+from processor import accuracy
+from profiling import NULL_PROFILER, peak_memory
+
+
+def inference_mode():
+    """``torch.inference_mode`` where available, ``torch.no_grad`` on older PyTorch."""
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+def evaluate_loader(denoiser, target_model, loader, use_cuda, on_batch=None, prof=NULL_PROFILER, clean=True, adv=True,
+                    amp=FP32):
+    """Purify and classify every ``(x, x_adv, y)`` batch of ``loader`` without building autograd graphs.
+
+    Clean and adversarial images are concatenated, so each batch needs one denoiser and one target-model
+    forward. Both models must be in eval mode; BatchNorm then uses running statistics and the concatenation
+    gives the same outputs as two separate passes.
+
+    Args:
+        on_batch (callable, optional): called with the denoised adversarial images of every batch.
+        clean (bool): score the clean images. Default: ``True``.
+        adv (bool): score the adversarial images. Default: ``True``.
+        amp (Precision): autocast and memory-format policy for the forwards. Default: fp32.
+
+    Returns:
+        dict with ``clean_acc``, ``adv_acc`` (``None`` for a skipped part), ``images`` (all images that went
+        through the models), ``seconds``, ``images_per_sec`` and ``peak_mem_mb``.
+    """
+    top1_c = DeviceMeter()
+    top1 = DeviceMeter()
+    images = 0
+
+    if use_cuda:
+        torch.cuda.reset_peak_memory_stats()
+    start = time.time()
+
+    with inference_mode():
+        for x, x_adv, y in loader:
+            prof.mark('data')
+            if use_cuda:
+                with prof.phase('h2d'):
+                    x, x_adv, y = x.cuda(non_blocking=True), x_adv.cuda(non_blocking=True), y.cuda(non_blocking=True)
+
+            b = x.size(0) if clean else 0
+            with prof.phase('denoiser_fwd'), amp.autocast():
+                inputs = amp.prepare(torch.cat([t for t, keep in ((x, clean), (x_adv, adv)) if keep]))
+                x_smooth = inputs + denoiser(inputs)
+            with prof.phase('target_fwd'), amp.autocast():
+                logits = target_model(x_smooth)
+
+            with prof.phase('metrics'):
+                if clean:
+                    top1_c.update(accuracy(logits[:b], y), y.size(0))
+                if adv:
+                    top1.update(accuracy(logits[b:], y), y.size(0))
+            images += inputs.size(0)
+
+            if adv and on_batch is not None:
+                with prof.phase('save'):
+                    on_batch(x_smooth[b:])
+            prof.step(inputs.size(0))
+
+    if use_cuda:
+        torch.cuda.synchronize()
+    seconds = time.time() - start
+
+    return {'clean_acc': top1_c.avg if clean else None, 'adv_acc': top1.avg if adv else None, 'images': images,
+            'seconds': seconds,
+            'images_per_sec': images / max(seconds, 1e-12), 'peak_mem_mb': peak_memory(use_cuda)}
+
+
+def parity_report(denoiser, target_model, loader, use_cuda, modes=MODES, channels_last=False):
+    """Run ``evaluate_loader`` once per precision mode and compare each against fp32.
+
+    The models' memory format is left to the caller; ``channels_last`` only changes the input layout.
+
+    Returns:
+        list of dicts with ``precision``, ``clean_acc``, ``adv_acc``, ``d_clean``/``d_adv`` (difference to the
+        fp32 accuracy, in points) and ``images_per_sec``.
+    """
+    rows = []
+    base = None
+    for mode in modes:
+        if mode == 'fp16' and not use_cuda:
+            continue  # fp16 kernels are largely missing on CPU
+        stats = evaluate_loader(denoiser, target_model, loader, use_cuda,
+                                amp=Precision(mode, use_cuda, channels_last))
+        if base is None and mode == 'fp32':
+            base = stats
+        rows.append({'precision': mode, 'clean_acc': stats['clean_acc'], 'adv_acc': stats['adv_acc'],
+                     'images_per_sec': stats['images_per_sec']})
+    for row in rows:
+        row['d_clean'] = None if base is None else row['clean_acc'] - base['clean_acc']
+        row['d_adv'] = None if base is None else row['adv_acc'] - base['adv_acc']
+    return rows
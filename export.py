@@ -0,0 +1,92 @@
+"""Fused purify-and-classify module in eager, TorchScript and ``torch.compile`` forms.
+
+Loads the denoiser from ``{dataset}_vgg_best.pth`` and the target model from its ``.t7`` checkpoint, strips any
+``BalancedDataParallel``/``DataParallel`` wrapper and writes a frozen TorchScript file that needs neither the
+repository's network code nor the wrappers to run. Run from the repository root:
+
+    python export.py --target ./checkpoint/{target}.t7 --form trace
+"""
+import argparse
+import os
+
+import torch
+import torch.nn as nn
+
+from distributed import unwrap
+from serving import load_models
+
+FORMS = ('eager', 'trace', 'script', 'compile')
+
+
+class PurifyClassify(nn.Module):
+    """``target_model(x + denoiser(x))`` as one module, for inputs in ``[0, 1]``."""
+
+    def __init__(self, denoiser, target_model):
+        super(PurifyClassify, self).__init__()
+        self.denoiser = unwrap(denoiser)
+        self.target_model = unwrap(target_model)
+
+    def forward(self, x):
+        return self.target_model(x + self.denoiser(x))
+
+
+class PurifyClassifyImages(PurifyClassify):
+    """``PurifyClassify`` that also returns the purified images, as ``(x_smooth, logits)``."""
+
+    def forward(self, x):
+        x_smooth = x + self.denoiser(x)
+        return x_smooth, self.target_model(x_smooth)
+
+
+def build(denoiser, target_model, form='eager', example=None, return_images=False):
+    """Wrap the two networks in ``PurifyClassify`` (``PurifyClassifyImages`` with ``return_images``) and convert it
+    to ``form``.
+
+    ``trace`` records the forward on ``example`` (an Nx3xHxW batch) and freezes it; ``script`` compiles the Python
+    source, which every submodule must support; ``compile`` uses ``torch.compile`` and compiles lazily on the first
+    call of each input shape.
+    """
+    assert form in FORMS, 'Error: unknown form {}, expected one of {}'.format(form, FORMS)
+    module = (PurifyClassifyImages if return_images else PurifyClassify)(denoiser, target_model).eval()
+    if form == 'eager':
+        return module
+    if form == 'compile':
+        assert hasattr(torch, 'compile'), 'Error: torch.compile needs PyTorch 2.0 or newer'
+        return torch.compile(module)
+    with torch.no_grad():
+        if form == 'trace':
+            assert example is not None, 'Error: tracing needs an example batch'
+            module = torch.jit.trace(module, example)
+        else:
+            module = torch.jit.script(module)
+    return torch.jit.freeze(module)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the SCPD purify-and-classify path.')
+    parser.add_argument('--dataset', default='cifar10', type=str, help='dataset = [cifar10/cifar100]')
+    parser.add_argument('--denoiser', default='', type=str,
+                        help='denoiser weights (default: ./checkpoint_denoise/denoiser/{dataset}_vgg_best.pth)')
+    parser.add_argument('--target', required=True, type=str, help='target model .t7 checkpoint')
+    parser.add_argument('--image_size', default=32, type=int, help='input height and width')
+    parser.add_argument('--form', default='trace', type=str, help='TorchScript form = [trace/script]')
+    parser.add_argument('--return_images', default=0, type=int, help='also return the purified images')
+    parser.add_argument('--out', default='', type=str,
+                        help='output file (default: ./checkpoint_denoise/{dataset}_purify_classify.pt)')
+    args = parser.parse_args()
+    assert args.form in ('trace', 'script'), 'Error: only TorchScript forms can be saved'
+
+    denoiser_path = args.denoiser or './checkpoint_denoise/denoiser/{}_vgg_best.pth'.format(args.dataset)
+    denoiser, target_model = load_models(denoiser_path, args.target, use_cuda=False, image_size=args.image_size)
+    example = torch.rand(2, 3, args.image_size, args.image_size)
+    module = build(denoiser, target_model, args.form, example, bool(args.return_images))
+
+    out = args.out or './checkpoint_denoise/{}_purify_classify.pt'.format(args.dataset)
+    if os.path.dirname(out):
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+    torch.jit.save(module, out)
+    print('saved {} module to {}; load it with torch.jit.load'.format(args.form, out))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+import math
+import os
+import queue
+import threading
+from os.path import join
+
+import numpy as np
+import torch
+from PIL import Image
+
+FORMATS = ('png', 'npy', 'npz', 'memmap')
+
+
+def make_grid(tensor, nrow=8, padding=2, normalize=False, range=None, scale_each=False, pad_value=0):
+    """Make a grid of images.
+
+    Args:
+        tensor (Tensor or list): 4D mini-batch Tensor of shape (B x C x H x W)
+            or a list of images all of the same size.
+        nrow (int, optional): Number of images displayed in each row of the grid.
+            The final grid size is ``(B / nrow, nrow)``. Default: ``8``.
+        padding (int, optional): amount of padding. Default: ``2``.
+        normalize (bool, optional): If True, shift the image to the range (0, 1),
+            by the min and max values specified by :attr:`range`. Default: ``False``.
+        range (tuple, optional): tuple (min, max) where min and max are numbers,
+            then these numbers are used to normalize the image. By default, min and max
+            are computed from the tensor.
+        scale_each (bool, optional): If ``True``, scale each image in the batch of
+            images separately rather than the (min, max) over all images. Default: ``False``.
+        pad_value (float, optional): Value for the padded pixels. Default: ``0``.
+
+    Example:
+        See this notebook `here <https://gist.github.com/anonymous/bf16430f7750c023141c562f3e9f2a91>`_
+
+    """
+
+    if not (torch.is_tensor(tensor) or
+            (isinstance(tensor, list) and all(torch.is_tensor(t) for t in tensor))):
+        raise TypeError('tensor or list of tensors expected, got {}'.format(type(tensor)))
+
+    # if list of tensors, convert to a 4D mini-batch Tensor
+    if isinstance(tensor, list):
+        tensor = torch.stack(tensor, dim=0)
+
+    if tensor.dim() == 2:  # single image H x W
+        tensor = tensor.unsqueeze(0)
+    if tensor.dim() == 3:  # single image
+        if tensor.size(0) == 1:  # if single-channel, convert to 3-channel
+            tensor = torch.cat((tensor, tensor, tensor), 0)
+        tensor = tensor.unsqueeze(0)
+
+    if tensor.dim() == 4 and tensor.size(1) == 1:  # single-channel images
+        tensor = torch.cat((tensor, tensor, tensor), 1)
+
+    if normalize is True:
+        tensor = tensor.clone()  # avoid modifying tensor in-place
+        if range is not None:
+            assert isinstance(range, tuple), \
+                "range has to be a tuple (min, max) if specified. min and max are numbers"
+
+        def norm_ip(img, min, max):
+            img.clamp_(min=min, max=max)
+            img.add_(-min).div_(max - min + 1e-5)
+
+        def norm_range(t, range):
+            if range is not None:
+                norm_ip(t, range[0], range[1])
+            else:
+                norm_ip(t, float(t.min()), float(t.max()))
+
+        if scale_each is True:
+            for t in tensor:  # loop over mini-batch dimension
+                norm_range(t, range)
+        else:
+            norm_range(tensor, range)
+
+    if tensor.size(0) == 1:
+        return tensor.squeeze(0)
+
+    # make the mini-batch of images into a grid
+    nmaps = tensor.size(0)
+    xmaps = min(nrow, nmaps)
+    ymaps = int(math.ceil(float(nmaps) / xmaps))
+    height, width = int(tensor.size(2) + padding), int(tensor.size(3) + padding)
+    # every tile is an image with `padding` pad rows/columns above and left of it
+    tiles = tensor.new_full((ymaps * xmaps, 3, height, width), pad_value)
+    tiles[:nmaps, :, padding:, padding:] = tensor
+    grid = tiles.view(ymaps, xmaps, 3, height, width).permute(2, 0, 3, 1, 4).reshape(3, ymaps * height, xmaps * width)
+    # closing pad on the bottom and right
+    return torch.nn.functional.pad(grid, (0, padding, 0, padding), value=pad_value)
+
+
+def save_image(tensor, filename, nrow=8, padding=2, normalize=False, range=None, scale_each=False, pad_value=0):
+    """Save a given Tensor into an image file.
+
+    Args:
+        tensor (Tensor or list): Image to be saved. If given a mini-batch tensor,
+            saves the tensor as a grid of images by calling ``make_grid``.
+        **kwargs: Other arguments are documented in ``make_grid``.
+    """
+
+    grid = make_grid(tensor, nrow=nrow, padding=padding, pad_value=pad_value,
+                     normalize=normalize, range=range, scale_each=scale_each)
+    # Add 0.5 after unnormalizing to [0, 255] to round to nearest integer
+    ndarr = grid.mul_(255).add_(0.5).clamp_(0, 255).permute(1, 2, 0).to('cpu', torch.uint8).numpy()
+    im = Image.fromarray(ndarr)
+    # im = im.convert('L')
+    im.save(filename, quality=100)
+
+
+def to_uint8(images):
+    """Float images in ``[0, 1]`` to uint8 with the rounding of ``save_image``, without touching the input."""
+    return images.mul(255).add_(0.5).clamp_(0, 255).to(torch.uint8)
+
+
+class DenoisedWriter(object):
+    """Writes batches of denoised images from a pool of background threads.
+
+    Each submitted batch is converted to uint8 and copied to the CPU in one transfer, then handed to the
+    workers through a bounded queue, so the caller only blocks when the disk falls ``max_queue`` batches behind.
+
+    Formats:
+        ``png``: one ``{index}.png`` per image, numbered from 1 as ``evaluate()`` always did.
+        ``npy``: one ``batch_{k:05d}.npy`` uint8 array of shape (B, C, H, W) per batch.
+        ``npz``: like ``npy`` but compressed ``batch_{k:05d}.npz`` files with key ``images``.
+        ``memmap``: a single ``denoised.npy`` of shape (total, C, H, W); needs ``total``.
+    """
+
+    def __init__(self, root, fmt='png', total=None, num_workers=2, max_queue=8):
+        assert fmt in FORMATS, 'Error: unknown save format {}, expected one of {}'.format(fmt, FORMATS)
+        assert fmt != 'memmap' or total is not None, 'Error: memmap format needs the total number of images'
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.fmt = fmt
+        self.total = total
+        self.memmap = None
+        self.count = 0
+        self.batches = 0
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(num_workers)]
+        for w in self.workers:
+            w.start()
+
+    def submit(self, images):
+        """Queue a (B, C, H, W) batch of float images in ``[0, 1]``."""
+        if self.error is not None:
+            raise self.error
+        arr = to_uint8(images.detach()).cpu().numpy()
+        if self.fmt == 'memmap' and self.memmap is None:
+            self.memmap = np.lib.format.open_memmap(join(self.root, 'denoised.npy'), mode='w+', dtype=np.uint8,
+                                                    shape=(self.total,) + arr.shape[1:])
+        self.queue.put((self.batches, self.count, arr))
+        self.batches += 1
+        self.count += len(arr)
+
+    def _write(self, k, start, arr):
+        if self.fmt == 'png':
+            for n in range(len(arr)):
+                img = arr[n].transpose(1, 2, 0)
+                if img.shape[2] == 1:  # make_grid saves single-channel images as 3-channel
+                    img = np.repeat(img, 3, axis=2)
+                Image.fromarray(img).save(join(self.root, '{}.png'.format(start + n + 1)), quality=100)
+        elif self.fmt == 'npy':
+            np.save(join(self.root, 'batch_{:05d}.npy'.format(k)), arr)
+        elif self.fmt == 'npz':
+            np.savez_compressed(join(self.root, 'batch_{:05d}.npz'.format(k)), images=arr)
+        else:
+            self.memmap[start:start + len(arr)] = arr
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        """Wait for all queued batches to be written."""
+        for _ in self.workers:
+            self.queue.put(None)
+        for w in self.workers:
+            w.join()
+        if self.memmap is not None:
+            self.memmap.flush()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class GridSnapshotter(object):
+    """Saves image grids from a background thread so snapshots stay out of the timed loop.
+
+    ``max_per_epoch`` limits how many snapshots are taken after each ``new_epoch()`` call; ``-1`` keeps them all.
+    Snapshots are dropped rather than queued when the writer is ``max_queue`` grids behind, so the caller never
+    waits for the disk.
+    """
+
+    def __init__(self, save_fn, max_per_epoch=-1, max_queue=4):
+        self.save_fn = save_fn
+        self.max_per_epoch = max_per_epoch
+        self.taken = 0
+        self.dropped = 0
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def new_epoch(self):
+        self.taken = 0
+
+    def wants(self):
+        return self.max_per_epoch < 0 or self.taken < self.max_per_epoch
+
+    def submit(self, tensor, filename, **kwargs):
+        """Queue ``save_fn(tensor, filename, **kwargs)``; ``tensor`` must not be modified afterwards.
+
+        Raises the first error of an earlier save.
+        """
+        if self.error is not None:
+            raise self.error
+        if not self.wants():
+            return
+        self.taken += 1
+        try:
+            self.queue.put_nowait((tensor.detach(), filename, kwargs))
+        except queue.Full:
+            self.dropped += 1
+
+    def _work(self):
+        # keeps draining after a failed save, so the queue never fills up behind a dead writer
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            tensor, filename, kwargs = item
+            try:
+                self.save_fn(tensor.cpu(), filename, **kwargs)
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+
+    def close(self):
+        """Wait for the queued snapshots and raise the first error of any save."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from dataload_packed import batch_index
+
+META_FILE = 'meta.json'
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """sha256 of a file's contents."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def checkpoint_digest(path):
+    """sha256 identifying a checkpoint: the contents of a checkpoint file, or for a weight-only checkpoint
+    directory the digest of its tensors recorded in its metadata, which needs no read of the tensors."""
+    if os.path.isdir(path):
+        from weights import read_meta
+
+        return read_meta(path)['sha256']
+    return file_digest(path)
+
+
+def dataset_fingerprint(paths, length):
+    """Cheap fingerprint of a dataset from its length and the name, size and mtime of its files.
+
+    ``paths`` may be files or directories; the files directly inside a directory are all included, so
+    adding, removing or rewriting a sample changes the fingerprint without hashing any image data.
+    """
+    h = hashlib.sha256(str(length).encode())
+    for path in paths:
+        if os.path.isdir(path):
+            entries = sorted((e.name, e.stat()) for e in os.scandir(path) if e.is_file())
+        else:
+            entries = [(os.path.abspath(path), os.stat(path))]
+        for name, st in entries:
+            h.update('{}:{}:{}'.format(name, st.st_size, st.st_mtime_ns).encode())
+    return h.hexdigest()
+
+
+def _as_list(out):
+    if torch.is_tensor(out):
+        return [out], 'tensor'
+    return list(out), type(out).__name__
+
+
+def _from_list(feats, kind):
+    if kind == 'tensor':
+        return feats[0]
+    if kind == 'tuple':
+        return tuple(feats)
+    return list(feats)
+
+
+def build_cache(extractor, dataset, cache_dir, meta, batch_size=500, use_cuda=False):
+    """Run ``extractor`` over the clean images of ``dataset`` once and store its outputs as memory maps.
+
+    ``meta`` is written last together with ``complete: True`` so an interrupted build is rebuilt next time.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, drop_last=False)
+    n = len(dataset)
+    arrays = None
+    start = 0
+    with torch.no_grad():
+        for batch in loader:
+            x = batch[0]
+            if use_cuda:
+                x = x.cuda()
+            feats, kind = _as_list(extractor(x))
+            if arrays is None:
+                arrays = [np.lib.format.open_memmap(os.path.join(cache_dir, 'feat_{}.npy'.format(k)), mode='w+',
+                                                    dtype=np.float32, shape=(n,) + tuple(f.shape[1:]))
+                          for k, f in enumerate(feats)]
+            stop = start + x.size(0)
+            for arr, f in zip(arrays, feats):
+                arr[start:stop] = f.float().cpu().numpy()
+            start = stop
+
+    for arr in arrays:
+        arr.flush()
+    meta = dict(meta, kind=kind, num_feats=len(arrays), length=n, complete=True)
+    with open(os.path.join(cache_dir, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def open_cache(extractor, dataset, cache_root, checkpoint_path, data_paths, batch_size=500, use_cuda=False):
+    """Return the feature memory maps for ``dataset``, building them if no valid cache exists.
+
+    The cache lives in ``cache_root/<checkpoint hash>_<dataset fingerprint>``, so a new ``.t7`` checkpoint or
+    changed data lands in a new directory and is built from scratch. ``checkpoint_path`` is the checkpoint the
+    target model was loaded from, a ``.t7`` file or its weight-only conversion.
+
+    Returns:
+        (list of read-only ``np.memmap``, output kind of ``extractor``)
+    """
+    meta = {'checkpoint': os.path.abspath(checkpoint_path),
+            'checkpoint_sha256': checkpoint_digest(checkpoint_path),
+            'dataset': dataset_fingerprint(data_paths, len(dataset))}
+    cache_dir = os.path.join(cache_root, '{}_{}'.format(meta['checkpoint_sha256'][:16], meta['dataset'][:16]))
+
+    stored = None
+    if os.path.isfile(os.path.join(cache_dir, META_FILE)):
+        with open(os.path.join(cache_dir, META_FILE)) as f:
+            stored = json.load(f)
+    if not stored or not stored.get('complete') or stored['checkpoint_sha256'] != meta['checkpoint_sha256'] \
+            or stored['dataset'] != meta['dataset']:
+        stored = build_cache(extractor, dataset, cache_dir, meta, batch_size=batch_size, use_cuda=use_cuda)
+
+    feats = [np.load(os.path.join(cache_dir, 'feat_{}.npy'.format(k)), mmap_mode='c')
+             for k in range(stored['num_feats'])]
+    return feats, stored['kind']
+
+
+class CachedLogitsDataset(Dataset):
+    """Wraps a ``(x, x_adv, y)`` dataset and appends the cached clean features of the same samples.
+
+    Works for per-sample datasets and for the batch indexing of ``DatasetPacked_Dual``.
+    """
+
+    def __init__(self, dataset, feats):
+        self.dataset = dataset
+        self.feats = feats
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        x, x_adv, y = self.dataset[index]
+        idx = batch_index(index)
+        return x, x_adv, y, [torch.from_numpy(np.asarray(f[idx])) for f in self.feats]
+
+
+class CachedFeatures(torch.nn.Module):
+    """Feature extractor that answers for the clean batch from the cache.
+
+    Pass it to ``logits_criteria`` in place of ``Logits_tensor(target_model)`` and call ``prime(x, feats)``
+    before the loss. When the criterion calls the extractor on that very ``x`` tensor, or on a ``chunk`` of it
+    as the gradient-accumulation step does, the matching rows of the cached features are returned instead of
+    running the target model; any other input runs the wrapped extractor.
+    """
+
+    def __init__(self, extractor, kind='tensor'):
+        super(CachedFeatures, self).__init__()
+        self.extractor = extractor
+        self.kind = kind
+        self._x = None
+        self._feats = None
+
+    def prime(self, x, feats):
+        self._x = x
+        self._feats = feats
+
+    def _rows(self, x):
+        """Rows of the primed batch that ``x`` views along dim 0, or ``None``."""
+        if self._x is None:
+            return None
+        if x is self._x:
+            return 0, x.size(0)
+        base = self._x if self._x._base is None else self._x._base
+        if x._base is not base or x.dim() == 0 or x.stride() != self._x.stride() \
+                or x.shape[1:] != self._x.shape[1:]:
+            return None
+        start, rem = divmod(x.storage_offset() - self._x.storage_offset(), self._x.stride(0))
+        if rem or start < 0 or start + x.size(0) > self._x.size(0):
+            return None
+        return start, start + x.size(0)
+
+    def forward(self, x):
+        rows = self._rows(x)
+        if rows is None:
+            return self.extractor(x)
+        feats = self._feats
+        if rows != (0, self._x.size(0)):
+            feats = [f[rows[0]:rows[1]] for f in feats]
+        else:
+            self._x, self._feats = None, None
+        return _from_list(feats, self.kind)
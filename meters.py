@@ -0,0 +1,47 @@
+import torch
+import torch.distributed as dist
+
+
+class DeviceMeter(object):
+    """Drop-in for ``AverageMeter`` that keeps its running sum on the device of the values it is given.
+
+    ``update`` takes tensors without calling ``.item()``, so it never waits for the device. ``val``, ``avg`` and
+    ``sum`` are materialized to Python floats only when read, e.g. when a log line is formatted. The sum is
+    kept in float64 like the Python floats ``AverageMeter`` accumulates, so the reported numbers match.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._val = None
+        self._sum = None
+        self.count = 0
+
+    def update(self, val, n=1):
+        val = val.detach().double() if torch.is_tensor(val) else torch.tensor(float(val), dtype=torch.float64)
+        self._val = val
+        self._sum = val * n if self._sum is None else self._sum + val * n
+        self.count += n
+
+    @property
+    def val(self):
+        return 0.0 if self._val is None else self._val.item()
+
+    @property
+    def sum(self):
+        return 0.0 if self._sum is None else self._sum.item()
+
+    @property
+    def avg(self):
+        return 0.0 if self.count == 0 else self._sum.item() / self.count
+
+    def all_reduce(self, device):
+        """Sum the running totals over all processes; ``device`` must suit the process-group backend."""
+        total = torch.zeros(2, dtype=torch.float64, device=device)
+        if self._sum is not None:
+            total[0] = self._sum.reshape(())
+        total[1] = self.count
+        dist.all_reduce(total)
+        self._sum = total[0]
+        self.count = int(total[1].item())
@@ -0,0 +1,129 @@
+import queue
+import threading
+
+import torch
+import torch.nn.functional as F
+
+ATTACKS = ('pgd', 'fgsm')
+
+
+def _input_grad(model, x, y):
+    x = x.detach().requires_grad_(True)
+    loss = F.cross_entropy(model(x), y)
+    # gradient w.r.t. the input only, so the frozen model's parameter gradients are left untouched
+    grad, = torch.autograd.grad(loss, x)
+    return grad
+
+
+def fgsm(model, x, y, eps):
+    """Untargeted L-inf FGSM."""
+    with torch.enable_grad():
+        grad = _input_grad(model, x, y)
+    return (x + eps * grad.sign()).clamp_(0, 1).detach()
+
+
+def pgd(model, x, y, eps, alpha, steps, generator=None):
+    """Untargeted L-inf PGD with a uniform random start in the ``eps`` ball."""
+    noise = torch.rand(x.shape, generator=generator, device=x.device, dtype=x.dtype)
+    x_adv = (x + eps * (2 * noise - 1)).clamp_(0, 1)
+    with torch.enable_grad():
+        for _ in range(steps):
+            grad = _input_grad(model, x_adv, y)
+            x_adv = x_adv.detach() + alpha * grad.sign()
+            x_adv = torch.min(torch.max(x_adv, x - eps), x + eps).clamp_(0, 1)
+    return x_adv.detach()
+
+
+class OnlineAdvLoader(object):
+    """Replaces the stored ``x_adv`` of every batch with a fresh attack on ``model``.
+
+    A background thread reads batches from ``loader``, moves them to the GPU and attacks them, keeping up to
+    ``prefetch`` finished batches ahead of the consumer (``prefetch=1`` is double-buffering). On CUDA the attack
+    runs on its own stream, so it overlaps the denoiser update running on the default stream. Batches keep any
+    extra fields after ``(x, x_adv, y)``, e.g. cached clean features.
+
+    Args:
+        attack (str): ``pgd`` or ``fgsm``.
+        eps, alpha (float): L-inf budget and PGD step size, for images in ``[0, 1]``.
+        steps (int): PGD iterations.
+    """
+
+    def __init__(self, loader, model, attack='pgd', eps=8 / 255, alpha=2 / 255, steps=10, use_cuda=False,
+                 prefetch=1, seed=0):
+        assert attack in ATTACKS, 'Error: unknown online attack {}, expected one of {}'.format(attack, ATTACKS)
+        self.loader = loader
+        self.model = model
+        self.attack = attack
+        self.eps = eps
+        self.alpha = alpha
+        self.steps = steps
+        self.use_cuda = use_cuda
+        self.prefetch = prefetch
+        self.generator = torch.Generator(device='cuda' if use_cuda else 'cpu')
+        self.generator.manual_seed(seed)
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def sampler(self):
+        return self.loader.sampler
+
+    def _perturb(self, x, y):
+        if self.attack == 'fgsm':
+            return fgsm(self.model, x, y, self.eps)
+        return pgd(self.model, x, y, self.eps, self.alpha, self.steps, generator=self.generator)
+
+    def _produce(self, out, stop):
+        stream = torch.cuda.Stream() if self.use_cuda else None
+        try:
+            for batch in self.loader:
+                x, _, y = batch[:3]
+                event = None
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        x, y = x.cuda(non_blocking=True), y.cuda(non_blocking=True)
+                        x_adv = self._perturb(x, y)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                else:
+                    x_adv = self._perturb(x, y)
+                if not self._put(out, ((x, x_adv, y) + tuple(batch[3:]), event), stop):
+                    return
+        except Exception as e:
+            self._put(out, (e, None), stop)
+            return
+        self._put(out, (None, None), stop)
+
+    @staticmethod
+    def _put(out, item, stop):
+        # give up once the consumer has stopped iterating, instead of blocking on a full queue forever
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        out = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        worker = threading.Thread(target=self._produce, args=(out, stop), daemon=True)
+        worker.start()
+        try:
+            while True:
+                batch, event = out.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                if event is not None:
+                    torch.cuda.current_stream().wait_event(event)
+                    for t in batch:
+                        if torch.is_tensor(t):
+                            t.record_stream(torch.cuda.current_stream())
+                yield batch
+        finally:
+            stop.set()
+            worker.join()
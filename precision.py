@@ -0,0 +1,68 @@
+import contextlib
+
+import torch
+
+MODES = ('fp32', 'fp16', 'bf16')
+_DTYPES = {'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+class Precision(object):
+    """Autocast, loss scaling and memory-format policy shared by the train, test and evaluate loops.
+
+    ``fp16`` and ``bf16`` run forwards under ``torch.autocast``; ``fp16`` also scales losses with a
+    ``GradScaler`` so small gradients of the relativistic BCE and ACT losses do not underflow. One scaler serves
+    both optimizers: ``backward``/``step`` go through it for each loss and ``update`` is called once per
+    iteration. ``fp32`` with ``channels_last=False`` is a plain pass-through.
+    """
+
+    def __init__(self, mode='fp32', use_cuda=False, channels_last=False):
+        assert mode in MODES, 'Error: unknown precision {}, expected one of {}'.format(mode, MODES)
+        self.mode = mode
+        self.device_type = 'cuda' if use_cuda else 'cpu'
+        self.channels_last = channels_last
+        self.scaler = None
+        if mode == 'fp16':
+            if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+                self.scaler = torch.amp.GradScaler(self.device_type)
+            else:
+                self.scaler = torch.cuda.amp.GradScaler()
+
+    def autocast(self):
+        if self.mode == 'fp32':
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device_type, dtype=_DTYPES[self.mode])
+
+    def prepare_model(self, model):
+        if self.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        return model
+
+    def prepare(self, x):
+        if self.channels_last and x.dim() == 4:
+            return x.contiguous(memory_format=torch.channels_last)
+        return x
+
+    def backward(self, loss):
+        if self.scaler is not None:
+            loss = self.scaler.scale(loss)
+        loss.backward()
+
+    def step(self, optimizer):
+        if self.scaler is not None:
+            self.scaler.step(optimizer)
+        else:
+            optimizer.step()
+
+    def update(self):
+        if self.scaler is not None:
+            self.scaler.update()
+
+    def state_dict(self):
+        return {} if self.scaler is None else self.scaler.state_dict()
+
+    def load_state_dict(self, state):
+        if self.scaler is not None and state:
+            self.scaler.load_state_dict(state)
+
+
+FP32 = Precision('fp32')
@@ -0,0 +1,132 @@
+import json
+import os
+import resource
+import threading
+import time
+from collections import OrderedDict, deque
+
+import torch
+
+
+def peak_memory(use_cuda):
+    """Peak memory in MB: allocated CUDA memory on GPU, max resident set size on CPU."""
+    if use_cuda:
+        return torch.cuda.max_memory_allocated() / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase(object):
+    __slots__ = ('prof', 'name', 'start')
+
+    def __init__(self, prof, name):
+        self.prof = prof
+        self.name = name
+
+    def __enter__(self):
+        self.prof._sync()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.prof._sync()
+        self.prof._record(self.name, self.start, time.perf_counter())
+        return False
+
+
+class PhaseProfiler(object):
+    """Opt-in per-phase timer for the training and evaluation loops.
+
+    Wrap work in ``with prof.phase('name'):``, call ``prof.mark('data')`` right after a batch arrives to charge
+    the time since the previous phase to data loading, and ``prof.step(batch_size)`` at the end of every
+    iteration. A disabled profiler returns a shared no-op context, so instrumented code costs one attribute
+    check per phase when profiling is off.
+
+    CUDA kernels run asynchronously, so without ``sync_cuda`` a phase is charged the time to launch its work and
+    the wait shows up wherever the host next blocks. ``sync_cuda`` synchronizes at every phase boundary for
+    exact attribution at some throughput cost.
+
+    Trace events are kept in a ring buffer of ``max_events`` entries; totals cover the whole run.
+    """
+
+    def __init__(self, enabled=False, sync_cuda=False, use_cuda=False, max_events=200000):
+        self.enabled = enabled
+        self.sync_cuda = sync_cuda and use_cuda
+        self.use_cuda = use_cuda
+        self.events = deque(maxlen=max_events)
+        self.totals = OrderedDict()
+        self.counts = OrderedDict()
+        self.samples = 0
+        self.steps = 0
+        self.origin = time.perf_counter()
+        self.last = self.origin
+        if enabled and use_cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NULL_PHASE
+        return _Phase(self, name)
+
+    def mark(self, name):
+        """Record the time since the end of the last phase or step as ``name``."""
+        if self.enabled:
+            self._record(name, self.last, time.perf_counter())
+
+    def step(self, samples):
+        if self.enabled:
+            self.samples += samples
+            self.steps += 1
+            self.last = time.perf_counter()
+
+    def _sync(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+
+    def _record(self, name, start, end):
+        self.totals[name] = self.totals.get(name, 0.0) + (end - start)
+        self.counts[name] = self.counts.get(name, 0) + 1
+        self.events.append((name, start, end, threading.get_ident()))
+        self.last = end
+
+    def summary(self):
+        wall = self.last - self.origin
+        phases = OrderedDict()
+        for name, total in self.totals.items():
+            phases[name] = {'count': self.counts[name], 'total_s': total,
+                            'mean_ms': 1e3 * total / self.counts[name], 'share': total / wall if wall > 0 else 0.0}
+        return {'wall_s': wall, 'steps': self.steps, 'samples': self.samples,
+                'samples_per_sec': self.samples / wall if wall > 0 else 0.0,
+                'peak_mem_mb': peak_memory(self.use_cuda), 'phases': phases}
+
+    def chrome_trace(self):
+        pid = os.getpid()
+        events = [{'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                   'ts': 1e6 * (start - self.origin), 'dur': 1e6 * (end - start)}
+                  for name, start, end, tid in self.events]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export(self, out_dir, tag):
+        """Write ``{tag}_summary.json`` and ``{tag}_trace.json`` (load in chrome://tracing or Perfetto)."""
+        if not self.enabled:
+            return None
+        os.makedirs(out_dir, exist_ok=True)
+        summary = self.summary()
+        with open(os.path.join(out_dir, '{}_summary.json'.format(tag)), 'w') as f:
+            json.dump(summary, f, indent=2)
+        with open(os.path.join(out_dir, '{}_trace.json'.format(tag)), 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        return summary
+
+
+NULL_PROFILER = PhaseProfiler(enabled=False)
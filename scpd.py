@@ -0,0 +1,1004 @@
+"""Importable core of SCPD: argument parsing, dataset construction, model loading, training and evaluation.
+
+Nothing is built or imported at import time: ``build_parser`` and ``parse_args`` work without torch, and every
+torch-dependent module is imported by the ``Experiment`` methods that use it. ``Experiment`` constructs every
+dataset, network, loss and optimizer on first use, so a TEST run never reads the training set and another process
+can drive training or evaluation directly:
+
+    from scpd import Experiment, parse_args
+
+    exp = Experiment(parse_args(['--mode', '1']))
+    exp.evaluate(exp.args.path_denoiser, exp.args.saveroot)
+
+``main.py`` is the command line wrapper; it only adds the log file.
+"""
+import argparse
+import functools
+import logging
+import math
+import os
+import time
+from os.path import join
+
+TRAIN_AND_TEST = 0
+TEST = 1
+SWEEP = 2
+
+
+def setup_seed(seed):
+    import numpy as np
+    import torch
+
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+    np.random.seed(seed)
+    # torch.backends.cudnn.deterministic = True
+
+
+def adjust_learning_rate(init, epoch):
+    optim_factor = 0
+    if epoch > 60:
+        optim_factor = 3
+    elif epoch > 50:
+        optim_factor = 2
+    elif epoch > 40:
+        optim_factor = 1
+
+    return init * math.pow(0.3, optim_factor)
+
+
+def get_hms(seconds):
+    m, s = divmod(seconds, 60)
+    h, m = divmod(m, 60)
+
+    return h, m, s
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='PyTorch CIFAR-10 Training. See code for default values.')
+
+    # STORAGE LOCATION VARIABLES
+    parser.add_argument('--traindirs_cln', default='', type=str, help='path of clean trainset')
+    parser.add_argument('--traindirs_adv', default='', type=str, help='path of adversarial trainset')
+    parser.add_argument('--traindirs_label', default='', type=str, help='path of training label')
+
+    parser.add_argument('--testdirs_cln', default='', type=str, help='path of clean testset')
+    parser.add_argument('--testdirs_label', default='', type=str, help='path of test label')
+    parser.add_argument('--attack', default='PGD', type=str, help='for define path of adversarial testset')
+    parser.add_argument('--target', default=0, type=str, help='target attack or not')
+    parser.add_argument('--attacks', default='', type=str, help='comma-separated attacks to evaluate in SWEEP mode')
+    parser.add_argument('--targets', default='0,1', type=str, help='comma-separated target settings for SWEEP mode')
+
+    parser.add_argument('--save_dir', '--sd', default='', type=str, help='Path to Model')
+    parser.add_argument('--net_type', default='vgg', type=str, help='model')
+    parser.add_argument('--depth', default=28, type=int, help='depth of model')
+    parser.add_argument('--widen_factor', default=10, type=int, help='width of model')
+    parser.add_argument('--dropout', default=0.3, type=float, help='dropout_rate')
+    parser.add_argument('--dataset', default='cifar10', type=str, help='dataset = [cifar10/cifar100/svhn]')
+    parser.add_argument('--Tcheckpoint', default='')
+    parser.add_argument('--layer-name', type=str, default=None, help='last convolutional layer name')
+    # parser.add_argument('--weight_mse', default=0, type=float, help='weight_mse 0.1')
+    parser.add_argument('--weight_adv', default=5e-3, type=float, help='weight_adv 0.001')
+    parser.add_argument('--weight_act', default=1e3, type=float, help='weight_act')
+
+    # MODEL HYPERPARAMETERS
+    parser.add_argument('--lr', default=0.001, metavar='lr', type=float, help='Learning rate')
+    parser.add_argument('--itr', default=70, metavar='iter', type=int, help='Number of iterations')
+    parser.add_argument('--batch_size', default=200, metavar='batch_size', type=int, help='Batch size')
+    parser.add_argument('--eval_batch_size', default=0, type=int, help='test/evaluate batch size (0: --batch_size)')
+    parser.add_argument('--accum_steps', default=0, type=int,
+                        help='split every training batch into N accumulated micro-batches (0: 1, or set by --autotune)')
+    parser.add_argument('--autotune', default=0, type=int,
+                        help='probe the largest and fastest micro-batch and eval batch that fit in memory')
+    parser.add_argument('--max_batch', default=1024, type=int, help='largest batch size --autotune tries')
+    parser.add_argument('--memory_fraction', default=0.9, type=float, help='share of GPU memory --autotune may use')
+    parser.add_argument('--weight_decay', '--wd', default=2e-4, type=float, help='weight decay (default: 2e-4)')
+
+    # OTHER PROPERTIES
+    parser.add_argument('--mode', default=0, type=int, help='0-TRAIN_AND_TEST,1-TEST,2-SWEEP)')
+    parser.add_argument('--print_freq', '-p', default=10, type=int, help='print frequency (default: 10)')
+    parser.add_argument('--save_freq', '-f', default=5, type=int, help='print frequency (default: 10)')
+    parser.add_argument('--save_best', default=1, type=int, help='Wether to save the best model')
+    parser.add_argument('--save_state', default=1, type=int, help='Wether to save the full training state every epoch')
+    parser.add_argument('--resume', default='', type=str, help='training state to resume from')
+    parser.add_argument('--save_denoised', default=0, type=int, help='Wether to save the denoised image')
+    parser.add_argument('--gpu', default="0,1", type=str, help='GPU devices to use (0-7) (default: 0,1)')
+    parser.add_argument('--path_denoiser', default='', type=str, help='Denoiser path')
+    parser.add_argument('--saveroot', default='', type=str, help='output images')
+    parser.add_argument('--save_format', default='png', type=str, help='denoised output = [png/npy/npz/memmap]')
+    parser.add_argument('--save_workers', default=2, type=int, help='threads writing denoised images')
+    parser.add_argument('--grid_img', default='', type=str, help='output grid images')
+    parser.add_argument('--snapshot_batches', default=-1, type=int,
+                        help='grid snapshots saved per test epoch, taken every print_freq batches (-1: all)')
+    parser.add_argument('--fused_step', default=0, type=int, help='run the denoiser once per training step')
+    parser.add_argument('--check_fused', default=0, type=int,
+                        help='compare fused and two-pass steps on the first batch')
+    parser.add_argument('--profile', default=0, type=int, help='record per-phase timings of train/test/evaluate')
+    parser.add_argument('--profile_sync', default=0, type=int,
+                        help='synchronize CUDA at phase boundaries when profiling')
+    parser.add_argument('--profile_dir', default='', type=str, help='output of profile summaries and traces')
+    parser.add_argument('--distributed', default=0, type=int, help='one process per device, launched with torchrun')
+    parser.add_argument('--dist_backend', default='nccl', type=str, help='process group backend = [nccl/gloo]')
+    parser.add_argument('--online_attack', default='', type=str,
+                        help='generate training x_adv on the fly against the target model = [pgd/fgsm]')
+    parser.add_argument('--attack_eps', default=8 / 255, type=float, help='L-inf budget of the online attack')
+    parser.add_argument('--attack_alpha', default=2 / 255, type=float, help='PGD step size of the online attack')
+    parser.add_argument('--attack_steps', default=10, type=int, help='PGD iterations of the online attack')
+    parser.add_argument('--precision', default='fp32', type=str, help='forward precision = [fp32/fp16/bf16]')
+    parser.add_argument('--channels_last', default=0, type=int, help='run the models in channels-last memory format')
+    parser.add_argument('--precision_report', default=0, type=int,
+                        help='in TEST mode, also compare accuracy and throughput of every precision against fp32')
+    parser.add_argument('--val_every', default=1, type=int, help='validate every N epochs (and after the last one)')
+    parser.add_argument('--val_subset', default=0, type=int,
+                        help='validate on a fixed random subset of N images (0: all)')
+    parser.add_argument('--val_seed', default=0, type=int, help='seed choosing the validation subset')
+    parser.add_argument('--val_async', default=0, type=int,
+                        help='evaluate snapshots on the full test set in worker processes while training continues')
+    parser.add_argument('--val_workers', default=1, type=int, help='concurrent validation worker processes')
+    parser.add_argument('--val_gpu', default='', type=str,
+                        help='GPUs of the validation workers, or cpu (default: --gpu)')
+    parser.add_argument('--packed', default=0, type=int, help='read memory-mapped shards made by dataload_packed.py')
+    parser.add_argument('--logit_cache', default=0, type=int,
+                        help='serve clean target-model features from a disk cache')
+
+    return parser
+
+
+def parse_args(argv=None):
+    """Parse ``argv`` (default: ``sys.argv[1:]``) and fill in the data, checkpoint and output paths."""
+    args = build_parser().parse_args(argv)
+    args.attacks = args.attacks.split(',') if args.attacks else [args.attack]
+    args.targets = [int(t) for t in args.targets.split(',')]
+    if args.mode == SWEEP:
+        args.attack, args.target = args.attacks[0], args.targets[0]
+
+    # define path
+    args.traindirs_cln = './saved_data_logits/{}_{}/train/clean/npy'.format(args.net_type, args.dataset)
+    args.traindirs_adv = './saved_data_logits/{}_{}/train/adv/npy'.format(args.net_type, args.dataset)
+    args.traindirs_label = './saved_data_logits/{}_{}/train/label_true.pkl'.format(args.net_type, args.dataset)
+    args.testdirs_cln = './saved_data/{}/{}/test_clean/npy'.format(args.dataset, args.net_type)
+    args.testdirs_label = './saved_data/{}/{}/test_clean/label_true.pkl'.format(args.dataset, args.net_type)
+    args.packed_train = './saved_data_packed/{}_{}/train'.format(args.net_type, args.dataset)
+    args.packed_test_cln = './saved_data_packed/{}/{}/test_clean'.format(args.dataset, args.net_type)
+    args.cache_root = './saved_data_cache/{}_{}'.format(args.net_type, args.dataset)
+    args.Tcheckpoint = './checkpoint'
+    args.save_dir = './checkpoint_denoise/denoiser'
+    args.path_denoiser = './checkpoint_denoise/denoiser/{}_{}_best.pth'.format(args.dataset, 'vgg')
+    args.state_path = './checkpoint_denoise/denoiser/{}_{}_state.pth'.format(args.dataset, args.net_type)
+    args.val_dir = './checkpoint_denoise/denoiser/val_{}_{}'.format(args.dataset, args.net_type)
+    args.saveroot = './results/defense/adv/{}_{}_{}'.format(args.dataset, args.net_type, args.attack, args.target)
+    args.sweep_dir = './results/sweep'
+    args.grid_img = './results/grid_img/{}_{}'.format(args.dataset, args.net_type)
+    args.profile_dir = './results/profile/{}_{}'.format(args.dataset, args.net_type)
+    args.target = int(args.target)
+    return args
+
+
+class Experiment(object):
+    """One SCPD configuration, with everything it needs built lazily.
+
+    Datasets, loaders, networks, losses, optimizers and the background writers are ``cached_property``
+    attributes: each is constructed, moved to the devices and wrapped the first time it is read. ``run`` does
+    what the ``--mode`` asks; ``fit``, ``train``, ``test``, ``evaluate`` and ``sweep`` can be called directly.
+
+    Args:
+        args: namespace from ``parse_args``.
+        seed (int, optional): seed for the torch and numpy generators; ``None`` leaves them alone. Default: ``0``.
+    """
+
+    def __init__(self, args, seed=0):
+        import torch
+
+        from distributed import init_distributed, is_main_process
+
+        self.args = args
+        if seed is not None:
+            setup_seed(seed)
+        os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+
+        logging.info("Using {}".format(args.dataset))
+        logging.info("Using {}".format(args.net_type))
+        logging.info("Using {}".format(args.attack))
+        logging.info("To test: {} {}".format(args.attack, 'untarget' if not args.target else 'target'))
+
+        self.save_dir = args.save_dir
+        self.start_epoch = 1
+        self.learning_rate = args.lr
+        self.batch_size = args.batch_size
+        self.num_epochs = args.itr
+        self.print_freq = args.print_freq
+        self.use_cuda = torch.cuda.is_available()
+        self.world_size, self.local_rank = 1, 0
+
+        if args.distributed:
+            assert args.mode == TRAIN_AND_TEST, 'Error: distributed mode only supports TRAIN_AND_TEST'
+            _, self.world_size, self.local_rank = init_distributed(args.dist_backend)
+            self.use_cuda = self.use_cuda and args.dist_backend == 'nccl'
+            # --batch_size stays the global batch
+            self.batch_size = args.batch_size // self.world_size
+            if not is_main_process():
+                logging.disable(logging.CRITICAL)
+            logging.info('| Distributed: {} processes, {} backend, {} per process'.format(
+                self.world_size, args.dist_backend, self.batch_size))
+
+    # ---------------------------------------------------------------- data
+
+    def build_loader(self, data, shuffle):
+        from torch.utils.data import DataLoader, DistributedSampler
+
+        from dataload_packed import packed_loader
+        from distributed import ShardSampler
+
+        # shuffled loaders are for training, the others for test/evaluate and get the inference batch size
+        size = self.batch_size if shuffle else self.eval_batch_size
+        sampler = None
+        if self.args.distributed:
+            sampler = DistributedSampler(data, shuffle=True) if shuffle else ShardSampler(data)
+        if self.args.packed:
+            return packed_loader(data, batch_size=size, shuffle=shuffle, drop_last=False, sampler=sampler)
+        return DataLoader(data, batch_size=size, shuffle=shuffle and sampler is None, drop_last=False,
+                          sampler=sampler)
+
+    def test_paths(self, attack, target):
+        args = self.args
+        mode = 'untarget' if not target else 'target'
+        if args.packed:
+            adv_dirs = './saved_data_packed/{}/{}/test_{}/adv/{}'.format(args.dataset, args.net_type, attack, mode)
+            return args.packed_test_cln, adv_dirs, None
+        adv_dirs = './saved_data/{}/{}/test_{}/adv/{}/npy'.format(args.dataset, args.net_type, attack, mode)
+        return args.testdirs_cln, adv_dirs, args.testdirs_label
+
+    def build_test_data(self, attack, target):
+        cln_dirs, adv_dirs, label_dirs = self.test_paths(attack, target)
+        if self.args.packed:
+            from dataload_packed import DatasetPacked_Dual
+
+            return DatasetPacked_Dual(cln_dirs=cln_dirs, adv_dirs=adv_dirs)
+        from torchvision import transforms
+
+        from dataload import DatasetNPY_Dual
+
+        return DatasetNPY_Dual(imgcln_dirs=cln_dirs, imgadv_dirs=adv_dirs, label_dirs=label_dirs,
+                               transform=transforms.ToTensor())
+
+    @functools.cached_property
+    def _train_source(self):
+        """The training set as stored on disk and the paths the logit cache fingerprints."""
+        args = self.args
+        if args.packed:
+            from dataload_packed import DatasetPacked_Dual
+
+            return DatasetPacked_Dual(cln_dirs=args.packed_train, adv_dirs=args.packed_train), [args.packed_train]
+        from torchvision import transforms
+
+        from dataload import DatasetNPY_Dual
+
+        # online attacks overwrite x_adv, so a missing precomputed set is replaced by the clean images
+        if args.online_attack and not os.path.isdir(args.traindirs_adv):
+            args.traindirs_adv = args.traindirs_cln
+        data = DatasetNPY_Dual(imgcln_dirs=args.traindirs_cln, imgadv_dirs=args.traindirs_adv,
+                               label_dirs=args.traindirs_label, transform=transforms.ToTensor())
+        return data, [args.traindirs_cln, args.traindirs_label]
+
+    @functools.cached_property
+    def _feature_cache(self):
+        """``(feats, kind)`` of the clean-feature cache, or ``None`` without ``--logit_cache``."""
+        from distributed import is_main_process
+
+        args = self.args
+        if not (args.logit_cache and args.mode == TRAIN_AND_TEST):
+            return None
+        from distributed import barrier
+        from logit_cache import open_cache
+
+        logging.info('| Loading clean feature cache from ' + args.cache_root)
+        # the main process builds a missing cache while the others wait, then everyone maps it
+        if not is_main_process():
+            barrier()
+        data, paths = self._train_source
+        cache = open_cache(self._features, data, args.cache_root, self.target_load_path, paths,
+                           batch_size=self.batch_size, use_cuda=self.use_cuda)
+        if is_main_process():
+            barrier()
+        return cache
+
+    @functools.cached_property
+    def train_data(self):
+        data = self._train_source[0]
+        if self._feature_cache is not None:
+            from logit_cache import CachedLogitsDataset
+
+            data = CachedLogitsDataset(data, self._feature_cache[0])
+        return data
+
+    @functools.cached_property
+    def train_loader(self):
+        args = self.args
+        loader = self.build_loader(self.train_data, shuffle=True)
+        if args.online_attack:
+            from online_attack import OnlineAdvLoader
+
+            logging.info('| Online {} attack, eps {:.4f}'.format(args.online_attack, args.attack_eps))
+            loader = OnlineAdvLoader(loader, self.target_model, attack=args.online_attack, eps=args.attack_eps,
+                                     alpha=args.attack_alpha, steps=args.attack_steps, use_cuda=self.use_cuda)
+        return loader
+
+    @functools.cached_property
+    def test_data(self):
+        return self.build_test_data(self.args.attack, self.args.target)
+
+    @functools.cached_property
+    def test_loader(self):
+        return self.build_loader(self.test_data, shuffle=False)
+
+    @functools.cached_property
+    def val_data(self):
+        from validation import subset
+
+        return subset(self.test_data, self.args.val_subset, self.args.val_seed)
+
+    @functools.cached_property
+    def val_loader(self):
+        return self.build_loader(self.val_data, shuffle=False) if self.val_data is not self.test_data \
+            else self.test_loader
+
+    # ---------------------------------------------------------------- models
+
+    @functools.cached_property
+    def amp(self):
+        from precision import Precision
+
+        return Precision(self.args.precision, use_cuda=self.use_cuda, channels_last=bool(self.args.channels_last))
+
+    def _place(self, module, trained=True):
+        """Move a network to the devices the way training runs it: ``DistributedDataParallel`` for ``trained``
+        networks in distributed mode, ``BalancedDataParallel`` over the visible GPUs otherwise."""
+        import torch.backends.cudnn as cudnn
+
+        module = self.amp.prepare_model(module)
+        if self.args.distributed:
+            from torch.nn.parallel import DistributedDataParallel
+
+            if self.use_cuda:
+                module = module.cuda()
+                cudnn.benchmark = True
+            if trained:
+                device_ids = [self.local_rank] if self.use_cuda else None
+                module = DistributedDataParallel(module, device_ids=device_ids)
+        elif self.use_cuda:
+            from utils.BalancedDataParallel import BalancedDataParallel
+
+            # print(">>> SENDING MODEL TO GPU...")
+            logging.info(">>> SENDING MODEL TO GPU...")
+            module = BalancedDataParallel(30, module, dim=0).cuda()
+            cudnn.benchmark = True
+        return module
+
+    @functools.cached_property
+    def denoiser(self):
+        from networks.denoiser import Denoiser
+
+        # Load Denoiser(unet-like)
+        # denoiser = NRP(3,3,64,5)
+        return self._place(Denoiser(x_h=32, x_w=32))
+
+    @functools.cached_property
+    def netD(self):
+        from networks.networks_NRP import Discriminator
+
+        return self._place(Discriminator(3, 32))
+
+    @functools.cached_property
+    def target_path(self):
+        from example_logits import getNetwork
+
+        assert os.path.isdir(self.args.Tcheckpoint), 'Error: No Tcheckpoint directory found!'
+        _, file_name = getNetwork(self.args)
+        return self.args.Tcheckpoint + '/' + file_name + self.args.dataset + '.t7'
+
+    @functools.cached_property
+    def target_load_path(self):
+        """``target_path``, or the weight-only conversion of it that ``target_model`` loads instead."""
+        from weights import prefer_weights
+
+        return prefer_weights(self.target_path)
+
+    @functools.cached_property
+    def target_model(self):
+        # print('\n[Test Phase] : Model setup')
+        from checkpointing import load_pickled
+        from weights import is_weights, load_module
+
+        logging.info('\n[Test Phase] : Model setup')
+        # a weight-only conversion made by weights.py maps instead of unpickling the whole network
+        path = self.target_load_path
+        target_model = load_module(path) if is_weights(path) else load_pickled(path)['net']
+        # target_model only runs forward passes, so it needs no gradient all-reduce
+        target_model = self._place(target_model, trained=False)
+        return target_model.eval()
+
+    # ---------------------------------------------------------------- losses and optimization
+
+    @functools.cached_property
+    def _features(self):
+        from example_logits import Logits_tensor
+
+        return Logits_tensor(self.target_model)
+
+    @functools.cached_property
+    def act_features(self):
+        """The feature extractor of ``ACT_stable``; a ``CachedFeatures`` with ``--logit_cache``."""
+        if self._feature_cache is None:
+            return self._features
+        from logit_cache import CachedFeatures
+
+        return CachedFeatures(self._features, self._feature_cache[1])
+
+    @functools.cached_property
+    def ACT_stable(self):
+        from example_logits import logits_criteria
+
+        criterion = logits_criteria(self.act_features)
+        return criterion.cuda() if self.use_cuda else criterion
+
+    @functools.cached_property
+    def BCE_stable(self):
+        import torch
+
+        criterion = torch.nn.BCEWithLogitsLoss()
+        return criterion.cuda() if self.use_cuda else criterion
+
+    @functools.cached_property
+    def _plan(self):
+        """``(accum_steps, eval_batch_size)``, probed on the devices with ``--autotune``."""
+        import torch
+
+        from distributed import unwrap
+        from train_step import accumulated_train_step, fused_train_step, reference_train_step
+
+        args = self.args
+        accum_steps = args.accum_steps or 1
+        eval_batch_size = (args.eval_batch_size or args.batch_size) // self.world_size
+        if not args.autotune:
+            return accum_steps, eval_batch_size
+
+        from autotune import autotune, make_eval_fn, make_train_fn
+        from precision import Precision
+
+        logging.info('| Autotuning batch sizes up to {}'.format(args.max_batch))
+        denoiser = unwrap(self.denoiser) if args.distributed else self.denoiser
+
+        def make_train(accum_steps):
+            # time the step that train() will run with these accumulation steps
+            step = fused_train_step if args.fused_step else reference_train_step
+            if accum_steps > 1:
+                step = functools.partial(accumulated_train_step, accum_steps=accum_steps)
+            netD = unwrap(self.netD) if args.distributed else self.netD
+            # a loss scaler of its own, so trials on random images leave the training scale and growth state alone
+            amp = Precision(args.precision, use_cuda=self.use_cuda, channels_last=bool(args.channels_last))
+            return make_train_fn(step, denoiser, netD, self.target_model, self.BCE_stable, self.ACT_stable,
+                                 args.weight_adv, args.weight_act, self.use_cuda, amp=amp, lr=self.learning_rate,
+                                 weight_decay=args.weight_decay)
+
+        tuned = autotune(make_train if args.mode == TRAIN_AND_TEST else None,
+                         make_eval_fn(denoiser, self.target_model, self.use_cuda, amp=self.amp),
+                         self.batch_size, self.use_cuda, max_batch=args.max_batch,
+                         memory_fraction=args.memory_fraction)
+        for name in ('train', 'eval'):
+            for trial in tuned[name]:
+                steps = ' in {} steps'.format(trial['accum_steps']) if 'accum_steps' in trial else ''
+                logging.info('|   {} batch {batch}{}: {samples_per_sec:.1f} samples/sec, '
+                             'peak memory {peak_mem_mb:.0f}MB'.format(name, steps, **trial))
+        # --eval_batch_size is global like --batch_size; the probed batch is already per process
+        plan = [args.accum_steps or tuned['accum_steps'],
+                args.eval_batch_size // self.world_size if args.eval_batch_size else tuned['eval_batch']]
+        if args.distributed:
+            # every process must run the same number of backward passes per step
+            torch.distributed.broadcast_object_list(plan, src=0)
+        return tuple(plan)
+
+    @property
+    def accum_steps(self):
+        return self._plan[0]
+
+    @property
+    def eval_batch_size(self):
+        return self._plan[1]
+
+    @functools.cached_property
+    def train_step(self):
+        from train_step import accumulated_train_step, fused_train_step, reference_train_step
+
+        if self.accum_steps > 1:
+            if self.args.fused_step:
+                logging.info('| --fused_step does not apply to accumulated steps')
+            return functools.partial(accumulated_train_step, accum_steps=self.accum_steps)
+        return fused_train_step if self.args.fused_step else reference_train_step
+
+    @functools.cached_property
+    def optimizer(self):
+        from torch import optim
+
+        return optim.Adam(self.denoiser.parameters(), lr=self.learning_rate, weight_decay=self.args.weight_decay)
+
+    @functools.cached_property
+    def optimizer_D(self):
+        from torch import optim
+
+        return optim.Adam(self.netD.parameters(), lr=self.learning_rate, weight_decay=self.args.weight_decay)
+
+    # ---------------------------------------------------------------- output
+
+    @functools.cached_property
+    def checkpointer(self):
+        from checkpointing import AsyncCheckpointer
+
+        return AsyncCheckpointer()
+
+    @functools.cached_property
+    def snapshotter(self):
+        from distributed import is_main_process
+        from image_writer import GridSnapshotter, save_image
+
+        return GridSnapshotter(save_image, max_per_epoch=self.args.snapshot_batches if is_main_process() else 0)
+
+    @functools.cached_property
+    def evaluator(self):
+        """``AsyncEvaluator`` for ``--val_async`` on the main process, else ``None``."""
+        from distributed import is_main_process
+
+        args = self.args
+        if not (args.val_async and args.mode == TRAIN_AND_TEST and is_main_process()):
+            return None
+        from validation import AsyncEvaluator
+
+        val_cln, val_adv, val_label = self.test_paths(args.attack, args.target)
+        val_env = dict(os.environ)
+        if args.val_gpu and args.val_gpu != 'cpu':
+            val_env['CUDA_VISIBLE_DEVICES'] = args.val_gpu
+        return AsyncEvaluator({'target_path': self.target_path, 'image_size': 32, 'batch_size': self.eval_batch_size,
+                               'packed': bool(args.packed), 'cln_dirs': val_cln, 'adv_dirs': val_adv,
+                               'label_dirs': val_label, 'precision': args.precision,
+                               'channels_last': bool(args.channels_last),
+                               'use_cuda': self.use_cuda and args.val_gpu != 'cpu'},
+                              args.val_dir, self.checkpointer, max_workers=args.val_workers, env=val_env)
+
+    def load_denoiser(self, path):
+        """Load denoiser weights from a ``.pth`` state dict or its weight-only conversion (see ``weights.py``)."""
+        import torch
+
+        from distributed import unwrap
+        from weights import is_weights, load_state, prefer_weights
+
+        path = prefer_weights(path)
+        if is_weights(path):
+            unwrap(self.denoiser).load_state_dict(load_state(path))
+        else:
+            self.denoiser.load_state_dict(torch.load(path))
+
+    def save_checkpoint(self, state, save_dir, dataset, net_type, base_name="best_model"):
+        """Saves a CPU copy of the checkpoint to disk from the background checkpointer"""
+        from checkpointing import to_cpu
+        from distributed import is_main_process
+
+        filename = "{}_{}_best.pth".format(dataset, net_type)
+        filename = os.path.join(save_dir, filename)
+        if is_main_process():
+            self.checkpointer.save(to_cpu(state), filename)
+
+    def new_profiler(self):
+        from profiling import PhaseProfiler
+
+        return PhaseProfiler(enabled=bool(self.args.profile), sync_cuda=bool(self.args.profile_sync),
+                             use_cuda=self.use_cuda)
+
+    def export_profile(self, prof, tag):
+        from distributed import is_main_process
+
+        if not is_main_process():
+            return
+        summary = prof.export(self.args.profile_dir, tag)
+        if summary is not None:
+            logging.info('| Profile {}: {:.1f} samples/sec, peak memory {:.0f}MB, '.format(
+                tag, summary['samples_per_sec'], summary['peak_mem_mb']) +
+                ', '.join('{} {:.1%}'.format(k, v['share']) for k, v in summary['phases'].items()))
+
+    def select_best(self, result, top1_best):
+        """Keep the snapshot of an asynchronous evaluation as the best model if it beats ``top1_best``."""
+        args = self.args
+        if result['adv_acc'] is None:
+            # the snapshot may hold the best weights, so it stays on disk to be evaluated again
+            logging.info('| Evaluation of epoch {} failed, see {}; its snapshot {} is kept on purpose, rerun '
+                         'python -m validation on it'.format(result['epoch'],
+                                                             join(args.val_dir, 'e{}.log'.format(result['epoch'])),
+                                                             result['weights']))
+            return top1_best
+        logging.info(' * Epoch {epoch} ADV Prec@1 {adv_acc:.3f} on {images} images ({seconds:.1f}s)'.format(**result))
+        if result['adv_acc'] > top1_best:
+            top1_best = result['adv_acc']
+            os.replace(result['weights'], join(self.save_dir, '{}_{}_best.pth'.format(args.dataset, args.net_type)))
+            logging.info('save the best model:{}'.format(top1_best))
+        else:
+            os.remove(result['weights'])
+        return top1_best
+
+    # ---------------------------------------------------------------- loops
+
+    def train(self, epoch):
+        import torch
+
+        from distributed import set_sampler_epoch
+        from meters import DeviceMeter
+        from processor import AverageMeter, accuracy
+
+        args = self.args
+        denoiser, netD, target_model = self.denoiser, self.netD, self.target_model
+        optimizer, optimizer_D, amp = self.optimizer, self.optimizer_D, self.amp
+        train_loader = self.train_loader
+        denoiser.train()
+        netD.train()
+        set_sampler_epoch(train_loader, epoch)
+
+        for opt in (optimizer, optimizer_D):
+            for param_group in opt.param_groups:
+                param_group['lr'] = adjust_learning_rate(self.learning_rate, epoch)
+
+        losses = DeviceMeter()
+        batch_time = AverageMeter()
+        top1 = DeviceMeter()
+        prof = self.new_profiler()
+
+        end = time.time()
+
+        for i, batch in enumerate(train_loader):
+            prof.mark('data')
+            x, x_adv, y = batch[:3]
+
+            t_real = torch.ones((x.size(0), 1))
+            t_fake = torch.zeros((x.size(0), 1))
+            if self.use_cuda:
+                with prof.phase('h2d'):
+                    x, x_adv, y = x.cuda(), x_adv.cuda(), y.cuda()
+                    t_real, t_fake = t_real.cuda(), t_fake.cuda()
+            x, x_adv = amp.prepare(x), amp.prepare(x_adv)
+            if args.logit_cache:
+                self.act_features.prime(x, [f.cuda() if self.use_cuda else f for f in batch[3]])
+
+            loss_D, loss, logits_smooth = self.train_step(denoiser, netD, target_model, optimizer, optimizer_D,
+                                                          self.BCE_stable, self.ACT_stable, x, x_adv, t_real, t_fake,
+                                                          args.weight_adv, args.weight_act, prof=prof, amp=amp)
+
+            # Update Mean loss for current iteration
+
+            with prof.phase('metrics'):
+                losses.update(loss, x.size(0))
+                prec1 = accuracy(logits_smooth.data, y)
+                top1.update(prec1, x.size(0))
+
+            batch_time.update(time.time() - end)
+            end = time.time()
+
+            if i % self.print_freq == 0:
+                # print('Train-Epoch: [{0}][{1}/{2}]\t'
+                #       'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
+                #       'Loss {loss.val:.4f} ({loss.avg:.4f})\t'
+                #       'Prec@1 {top1.val:.3f} ({top1.avg:.3f})'.format(epoch, i, len(train_loader),
+                #                                                       batch_time=batch_time, loss=losses, top1=top1))
+                logging.info('Train-Epoch: [{0}][{1}/{2}]\t'
+                             'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
+                             'Loss {loss.val:.4f} ({loss.avg:.4f})\t'
+                             'Prec@1 {top1.val:.3f} ({top1.avg:.3f})'.format(epoch, i, len(train_loader),
+                                                                             batch_time=batch_time,
+                                                                             loss=losses, top1=top1))
+                prof.mark('log')
+            prof.step(x.size(0))
+
+        self.export_profile(prof, 'train_e{}'.format(epoch))
+
+    def test(self, epoch, loader=None):
+        import torch
+
+        from meters import DeviceMeter
+        from processor import AverageMeter, accuracy
+
+        args = self.args
+        denoiser, target_model, amp, snapshotter = self.denoiser, self.target_model, self.amp, self.snapshotter
+        loader = self.test_loader if loader is None else loader
+        denoiser.eval()
+        self.netD.eval()
+
+        batch_time = AverageMeter()
+        top1 = DeviceMeter()
+        snapshotter.new_epoch()
+        prof = self.new_profiler()
+
+        end = time.time()
+
+        with torch.no_grad():
+            for i, (x, x_adv, y) in enumerate(loader):
+                prof.mark('data')
+
+                if self.use_cuda:
+                    with prof.phase('h2d'):
+                        x, x_adv, y = x.cuda(), x_adv.cuda(), y.cuda()
+                x, x_adv = amp.prepare(x), amp.prepare(x_adv)
+
+                # Compute denoised image.
+                with prof.phase('denoiser_fwd'), amp.autocast():
+                    noise = denoiser.forward(x_adv)
+                    x_smooth = x_adv + noise
+
+                # Get logits from smooth and denoised image
+                with prof.phase('target_fwd'), amp.autocast():
+                    logits_smooth = target_model(x_smooth)
+
+                with prof.phase('metrics'):
+                    prec1 = accuracy(logits_smooth.data, y)
+                    top1.update(prec1, x.size(0))
+
+                batch_time.update(time.time() - end)
+                end = time.time()
+
+                if i % self.print_freq == 0:
+                    # print('Test-Epoch: [{0}][{1}/{2}]'
+                    #       'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
+                    #       'Prec@1 {top1.val:.3f} ({top1.avg:.3f})'.format(epoch, i, len(test_loader),
+                    #                                                       batch_time=batch_time, top1=top1))
+                    logging.info('Test-Epoch: [{0}][{1}/{2}]'
+                                 'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
+                                 'Prec@1 {top1.val:.3f} ({top1.avg:.3f})'.format(epoch, i, len(loader),
+                                                                                 batch_time=batch_time, top1=top1))
+                    prof.mark('log')
+                    if snapshotter.wants():
+                        with prof.phase('snapshot'):
+                            out = torch.stack((x, x_smooth))  # 2, bs, 3, 32, 32
+                            out = out.transpose(1, 0).contiguous()  # bs, 2, 3, 32, 32
+                            out = out.view(-1, x.size(-3), x.size(-2), x.size(-1))
+
+                            snapshotter.submit(out, join(args.grid_img, 'test_recon_{}.png'.format(i)), nrow=20)
+                prof.step(x.size(0))
+
+            self.export_profile(prof, 'test_e{}'.format(epoch))
+
+            if args.distributed:
+                top1.all_reduce('cuda' if self.use_cuda else 'cpu')
+            # print(' * ADV Prec@1 {top1.avg:.3f}'.format(top1=top1))
+            logging.info(' * ADV Prec@1 {top1.avg:.3f}'.format(top1=top1))
+            if epoch % args.save_freq == 0 and not args.save_best:
+                self.save_checkpoint(denoiser.state_dict(), self.save_dir, args.dataset, args.net_type)
+                # print('save the model')
+                logging.info('save the model')
+            return top1.avg
+
+    def evaluate(self, path_denoiser, saveroot):
+        from evaluation import evaluate_loader, parity_report
+        from image_writer import DenoisedWriter
+        from precision import MODES
+
+        args = self.args
+        denoiser, target_model = self.denoiser, self.target_model
+        self.load_denoiser(path_denoiser)
+        denoiser.eval()
+
+        writer = None
+        if args.save_denoised:
+            writer = DenoisedWriter(saveroot, fmt=args.save_format, total=len(self.test_data),
+                                    num_workers=args.save_workers)
+
+        prof = self.new_profiler()
+        try:
+            result = evaluate_loader(denoiser, target_model, self.test_loader, self.use_cuda,
+                                     on_batch=writer.submit if writer is not None else None, prof=prof, amp=self.amp)
+        finally:
+            if writer is not None:
+                writer.close()
+        self.export_profile(prof, 'evaluate')
+
+        print(' * Prec@1 {adv_acc:.4f}'.format(**result))
+        print(' * CLEAN Prec@1 {clean_acc:.3f}'.format(**result))
+        print(' * {images_per_sec:.1f} images/sec, {seconds:.2f}s, peak memory {peak_mem_mb:.0f}MB'.format(**result))
+
+        logging.info(' * Prec@1 {adv_acc:.4f}'.format(**result))
+        logging.info(' * CLEAN Prec@1 {clean_acc:.3f}'.format(**result))
+        logging.info(' * {images_per_sec:.1f} images/sec, {seconds:.2f}s, peak memory {peak_mem_mb:.0f}MB'.format(
+            **result))
+
+        if args.precision_report:
+            rows = parity_report(denoiser, target_model, self.test_loader, self.use_cuda, modes=MODES,
+                                 channels_last=bool(args.channels_last))
+            lines = ['{:<10}{:>10}{:>10}{:>10}{:>10}{:>12}'.format('precision', 'clean_acc', 'd_clean', 'adv_acc',
+                                                                   'd_adv', 'images/sec')]
+            lines += ['{precision:<10}{clean_acc:>10.3f}{d_clean:>+10.3f}{adv_acc:>10.4f}{d_adv:>+10.4f}'
+                      '{images_per_sec:>12.1f}'.format(**row) for row in rows]
+            print('\n'.join(lines))
+            logging.info('\n' + '\n'.join(lines))
+        return result
+
+    def sweep(self, path_denoiser):
+        from evaluation import evaluate_loader
+        from image_writer import DenoisedWriter
+
+        args = self.args
+        denoiser, target_model = self.denoiser, self.target_model
+        self.load_denoiser(path_denoiser)
+        denoiser.eval()
+
+        # clean images are shared by every attack, so they are scored once, in the pass over the first set that loads
+        clean_acc = None
+        rows = []
+        for attack in args.attacks:
+            for target in args.targets:
+                mode = 'untarget' if not target else 'target'
+                try:
+                    data = self.test_data if (attack, target) == (args.attack, args.target) \
+                        else self.build_test_data(attack, target)
+                except (OSError, AssertionError) as e:
+                    logging.info('| Skipping {} {}: {}'.format(attack, mode, e))
+                    continue
+
+                writer = None
+                if args.save_denoised:
+                    saveroot = './results/defense/adv/{}_{}_{}_{}'.format(args.dataset, args.net_type, attack, mode)
+                    writer = DenoisedWriter(saveroot, fmt=args.save_format, total=len(data),
+                                            num_workers=args.save_workers)
+                try:
+                    result = evaluate_loader(denoiser, target_model, self.build_loader(data, shuffle=False),
+                                             self.use_cuda, on_batch=writer.submit if writer is not None else None,
+                                             clean=clean_acc is None, amp=self.amp)
+                finally:
+                    if writer is not None:
+                        writer.close()
+                if clean_acc is None:
+                    clean_acc = result['clean_acc']
+                    logging.info(' * CLEAN Prec@1 {:.3f}'.format(clean_acc))
+                rows.append((attack, mode, clean_acc, result['adv_acc'], result['images_per_sec']))
+                logging.info(' * {} {} Prec@1 {:.4f}'.format(attack, mode, result['adv_acc']))
+
+        header = ('attack', 'mode', 'clean_acc', 'adv_acc', 'images/sec')
+        lines = ['{:<10}{:<10}{:>10}{:>10}{:>12}'.format(*header)]
+        lines += ['{:<10}{:<10}{:>10.3f}{:>10.4f}{:>12.1f}'.format(*row) for row in rows]
+        print('\n'.join(lines))
+        logging.info('\n' + '\n'.join(lines))
+
+        if not os.path.exists(args.sweep_dir):
+            os.makedirs(args.sweep_dir)
+        with open(join(args.sweep_dir, '{}_{}.csv'.format(args.dataset, args.net_type)), 'w') as f:
+            f.write(','.join(header) + '\n')
+            f.writelines('{},{},{:.4f},{:.4f},{:.1f}\n'.format(*row) for row in rows)
+        return rows
+
+    def fit(self):
+        """Train for ``--itr`` epochs with validation, checkpoints and best-model selection.
+
+        Returns:
+            the best validation accuracy.
+        """
+        from checkpointing import load_training_state, training_state
+        from distributed import is_main_process, unwrap
+        from train_step import STEP_TOLERANCE, check_fused_step, fuse_bn_momentum, fused_train_step
+        from validation import should_validate, wilson_interval
+
+        args = self.args
+        # built in this order so the initial weights match earlier releases for the same seed
+        denoiser, netD = self.denoiser, self.netD
+        optimizer, optimizer_D, amp = self.optimizer, self.optimizer_D, self.amp
+        num_epochs = self.num_epochs
+        # print("==================== TRAINING ====================")
+        # print('\n[Phase 3] : Training model')
+        # print('| Training Epochs = ' + str(num_epochs))
+        # print('| Initial Learning Rate = ' + str(learning_rate))
+        logging.info("==================== TRAINING ====================")
+        logging.info('\n[Phase 3] : Training model')
+        logging.info('| Training Epochs = ' + str(num_epochs))
+        logging.info('| Initial Learning Rate = ' + str(self.learning_rate))
+        logging.info('| Batch {} in {} accumulation steps, eval batch {}'.format(self.batch_size, self.accum_steps,
+                                                                                 self.eval_batch_size))
+
+        if args.check_fused:
+            x, x_adv = next(iter(self.train_loader))[:2]
+            if self.use_cuda:
+                x, x_adv = x.cuda(), x_adv.cuda()
+            # compare single-process steps; copies of the DistributedDataParallel wrappers would all-reduce gradients
+            diffs = check_fused_step(unwrap(denoiser) if args.distributed else denoiser,
+                                     unwrap(netD) if args.distributed else netD,
+                                     self.target_model, self.BCE_stable, self.ACT_stable, x, x_adv,
+                                     lr=self.learning_rate, weight_decay=args.weight_decay,
+                                     weight_adv=args.weight_adv, weight_act=args.weight_act)
+            logging.info('| Fused step max abs diff : ' +
+                         ', '.join('{} {:.3e}'.format(k, v) for k, v in diffs.items()))
+            assert max(diffs.values()) <= STEP_TOLERANCE, \
+                'Error: fused step differs from the two-pass step by more than {}'.format(STEP_TOLERANCE)
+        if self.train_step is fused_train_step:
+            fuse_bn_momentum(denoiser)
+
+        elapsed_time = 0
+        top1_best = 0
+        start_epoch = self.start_epoch
+        if args.resume:
+            state = load_training_state(args.resume, denoiser, netD, optimizer, optimizer_D)
+            start_epoch = state['epoch'] + 1
+            top1_best = state['best_acc']
+            elapsed_time = state.get('elapsed_time', 0)
+            amp.load_state_dict(state.get('precision'))
+            del state
+            logging.info('| Resumed from {} at epoch {}, best Acc@1 = {:.4f}'.format(
+                args.resume, start_epoch, top1_best))
+
+        evaluator = self.evaluator
+        for epoch in range(start_epoch, num_epochs + 1):
+            start_time = time.time()
+
+            self.train(epoch)
+            if should_validate(epoch, args.val_every, num_epochs):
+                if evaluator is not None:
+                    evaluator.submit(epoch, denoiser.state_dict())
+                # with --val_async the subset pass is only a quick signal; the full results pick the best model
+                if not args.val_async or args.val_subset:
+                    acc = self.test(epoch, self.val_loader)
+                    if args.val_subset:
+                        low, high = wilson_interval(acc, len(self.val_data))
+                        logging.info(' * Subset of {} images: Prec@1 {:.3f} (95% CI {:.3f}-{:.3f})'.format(
+                            len(self.val_data), acc, low, high))
+                    if not args.val_async and acc > top1_best:
+                        # code.interact(local=locals())
+                        top1_best = acc
+                        self.save_checkpoint(denoiser.state_dict(), self.save_dir, args.dataset, args.net_type)
+                        # print('save the best model:{}'.format(top1_best)
+                        logging.info('save the best model:{}'.format(top1_best))
+            if evaluator is not None:
+                for result in evaluator.poll():
+                    top1_best = self.select_best(result, top1_best)
+
+            epoch_time = time.time() - start_time
+            elapsed_time += epoch_time
+            # print('| Elapsed time : %d:%02d:%02d' % (get_hms(elapsed_time)))
+            logging.info('| Elapsed time : %d:%02d:%02d' % (get_hms(elapsed_time)))
+
+            if args.save_state and is_main_process():
+                self.checkpointer.save(training_state(denoiser, netD, optimizer, optimizer_D, epoch, top1_best,
+                                                      elapsed_time=elapsed_time, precision=amp.state_dict()),
+                                       args.state_path)
+
+        # print('\n[Phase 4] : Final')
+        # print('* Best results : Acc@1 = %.4f' % top1.avg)
+        if evaluator is not None:
+            for result in evaluator.close():
+                top1_best = self.select_best(result, top1_best)
+        self.close()
+
+        logging.info('\n[Phase 4] : Final')
+        logging.info('* Best results : Acc@1 = %.4f' % top1_best)
+        return top1_best
+
+    def close(self):
+        """Flush the background writers that were started and leave the process group."""
+        import torch
+
+        if 'checkpointer' in self.__dict__:
+            self.checkpointer.close()
+        if 'snapshotter' in self.__dict__:
+            self.snapshotter.close()
+            if self.snapshotter.dropped:
+                logging.info('| Dropped {} grid snapshots while the writer was busy'.format(self.snapshotter.dropped))
+        if self.args.distributed:
+            torch.distributed.destroy_process_group()
+
+    def run(self):
+        """Run what ``--mode`` selects."""
+        args = self.args
+        if args.mode == TRAIN_AND_TEST:
+            return self.fit()
+
+        try:
+            if args.mode == TEST:
+                # print("==================== TESTING ====================")
+                logging.info("==================== TESTING ====================")
+
+                return self.evaluate(args.path_denoiser, args.saveroot)
+
+            if args.mode == SWEEP:
+                logging.info("==================== SWEEP ====================")
+
+                return self.sweep(args.path_denoiser)
+        finally:
+            self.close()
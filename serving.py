@@ -0,0 +1,298 @@
+"""Long-running purification service: ``x + denoiser(x)`` followed by the target model, with dynamic batching.
+
+Requests are queued and grouped into micro-batches of at most ``--max_batch`` images; a batch is closed when it
+is full, or when no request is waiting and its oldest request has waited ``--max_latency_ms``. Run from the
+repository root:
+
+    python serving.py --target ./checkpoint/vgg-cifar10.t7 --port 8000
+
+``POST /classify`` returns logits and ``POST /purify`` purified images. Both take an ``.npy`` body with HxWx3 or
+NxHxWx3 uint8 images (the layout of the saved test sets) or Nx3xHxW float32 images in ``[0, 1]``, and answer with a
+float32 ``.npy``. ``GET /health`` reports batching statistics.
+"""
+import argparse
+import io
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import numpy as np
+import torch
+
+from evaluation import inference_mode
+from precision import FP32, MODES, Precision
+from weights import is_weights, load_denoiser_state, load_module, load_target, prefer_weights
+
+OUTPUTS = ('logits', 'images', 'both')
+# queued by close(); distinct from None, which marks an empty carry slot
+_CLOSE = object()
+
+
+def load_models(denoiser_path, target_path, use_cuda, image_size=32):
+    """Load the SCPD denoiser weights and the target model once, unwrapped and in eval mode.
+
+    Either path may be a pickled checkpoint or a weight-only checkpoint made by ``weights.py``; a weight-only
+    conversion next to a pickled file is used in its place.
+    """
+    denoiser_path, target_path = prefer_weights(denoiser_path), prefer_weights(target_path)
+    if is_weights(denoiser_path):
+        denoiser = load_module(denoiser_path)
+    else:
+        from networks.denoiser import Denoiser
+
+        denoiser = Denoiser(x_h=image_size, x_w=image_size)
+        denoiser.load_state_dict(load_denoiser_state(denoiser_path))
+    target_model = load_target(target_path)
+    if use_cuda:
+        denoiser, target_model = denoiser.cuda(), target_model.cuda()
+    return denoiser.eval(), target_model.eval()
+
+
+class _Request(object):
+    __slots__ = ('x', 'outputs', 'future', 'arrival')
+
+    def __init__(self, x, outputs):
+        self.x = x
+        self.outputs = outputs
+        self.future = Future()
+        self.arrival = time.perf_counter()
+
+
+class DynamicBatcher(object):
+    """Groups concurrent requests into micro-batches for one denoiser and one target-model forward.
+
+    A worker thread takes the oldest request and adds every request already queued behind it, then waits for more
+    while the oldest request has waited less than ``max_latency_ms``, until the batch holds ``max_batch_size``
+    images. Only requests of the same image size join. A request that would overflow the batch starts the next one;
+    a single request larger than ``max_batch_size`` runs alone.
+
+    Args:
+        max_batch_size (int): images per forward.
+        max_latency_ms (float): longest time a request waits for others to join its batch.
+        max_queue (int): queued requests before ``submit`` blocks.
+        amp (Precision): autocast and memory-format policy for the forwards. Default: fp32.
+    """
+
+    def __init__(self, denoiser, target_model, max_batch_size=64, max_latency_ms=5.0, use_cuda=False, amp=FP32,
+                 max_queue=1024):
+        self.denoiser = denoiser
+        self.target_model = target_model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1e3
+        self.use_cuda = use_cuda
+        self.amp = amp
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batches = 0
+        self.images = 0
+        self._carry = None
+        self._closed = False
+        # makes the closed check and the put in submit() atomic with close(), so nothing is queued after _CLOSE
+        self._lock = threading.Lock()
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def submit(self, x, outputs='logits'):
+        """Queue ``x`` (3xHxW or Nx3xHxW in ``[0, 1]``) and return a ``Future``.
+
+        The future resolves to CPU logits, purified images, or a ``(images, logits)`` pair, following
+        ``outputs``; a single image keeps its missing batch dimension.
+        """
+        assert outputs in OUTPUTS, 'Error: unknown output {}, expected one of {}'.format(outputs, OUTPUTS)
+        request = _Request(x, outputs)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('DynamicBatcher is closed')
+            self.queue.put(request)
+        return request.future
+
+    def __call__(self, x, outputs='logits'):
+        return self.submit(x, outputs).result()
+
+    def _next(self, block=True, timeout=None):
+        if self._carry is not None:
+            request, self._carry = self._carry, None
+            return request
+        return self.queue.get(block, timeout)
+
+    def _collect(self, first):
+        batch, n = [first], self._size(first)
+        deadline = first.arrival + self.max_latency
+        while n < self.max_batch_size:
+            try:
+                # requests already waiting join whatever the deadline, so a backlog still runs in full batches
+                request = self._next(block=False)
+            except queue.Empty:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._next(timeout=timeout)
+                except queue.Empty:
+                    break
+            # the close sentinel is carried too, so the worker stops right after this batch
+            if request is _CLOSE or self._size(request) + n > self.max_batch_size \
+                    or request.x.shape[-3:] != first.x.shape[-3:]:
+                self._carry = request
+                break
+            batch.append(request)
+            n += self._size(request)
+        return batch
+
+    @staticmethod
+    def _size(request):
+        return 1 if request.x.dim() == 3 else request.x.size(0)
+
+    def _work(self):
+        while True:
+            first = self._next()
+            if first is _CLOSE:
+                break
+            batch = self._collect(first)
+            try:
+                self._run(batch)
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+
+    def _run(self, batch):
+        x = torch.cat([r.x.unsqueeze(0) if r.x.dim() == 3 else r.x for r in batch])
+        if self.use_cuda:
+            x = x.cuda(non_blocking=True)
+        with inference_mode(), self.amp.autocast():
+            x = self.amp.prepare(x)
+            x_smooth = x + self.denoiser(x)
+            logits = self.target_model(x_smooth)
+        x_smooth, logits = x_smooth.float().cpu(), logits.float().cpu()
+        self.batches += 1
+        self.images += x.size(0)
+
+        start = 0
+        for r in batch:
+            end = start + self._size(r)
+            images, scores = x_smooth[start:end], logits[start:end]
+            if r.x.dim() == 3:
+                images, scores = images[0], scores[0]
+            start = end
+            if r.outputs == 'logits':
+                r.future.set_result(scores)
+            elif r.outputs == 'images':
+                r.future.set_result(images)
+            else:
+                r.future.set_result((images, scores))
+
+    def stats(self):
+        return {'batches': self.batches, 'images': self.images,
+                'mean_batch': self.images / self.batches if self.batches else 0.0, 'queued': self.queue.qsize()}
+
+    def close(self):
+        """Finish the queued requests and stop the worker."""
+        with self._lock:
+            self._closed = True
+            self.queue.put(_CLOSE)
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def decode_images(arr):
+    """HxWx3 / NxHxWx3 uint8 (like ``ToTensor``) or 3xHxW / Nx3xHxW float array to an Nx3xHxW float tensor."""
+    if arr.dtype == np.uint8:
+        if arr.ndim == 3:
+            arr = arr[None]
+        return torch.from_numpy(np.ascontiguousarray(arr.transpose(0, 3, 1, 2))).float().div_(255)
+    x = torch.from_numpy(np.asarray(arr, dtype=np.float32))
+    return x.unsqueeze(0) if x.dim() == 3 else x
+
+
+def _encode(array):
+    buf = io.BytesIO()
+    np.save(buf, array)
+    return buf.getvalue()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_server(batcher, host='127.0.0.1', port=8000):
+    """HTTP front end for ``batcher``; every connection gets its own thread, so requests batch together."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code, body, content_type):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/health':
+                return self._reply(404, b'not found', 'text/plain')
+            self._reply(200, json.dumps(batcher.stats()).encode(), 'application/json')
+
+        def do_POST(self):
+            outputs = {'/classify': 'logits', '/purify': 'images'}.get(self.path)
+            if outputs is None:
+                return self._reply(404, b'not found', 'text/plain')
+            try:
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                x = decode_images(np.load(io.BytesIO(body), allow_pickle=False))
+            except Exception as e:
+                return self._reply(400, str(e).encode(), 'text/plain')
+            try:
+                result = batcher(x, outputs)
+            except Exception as e:
+                return self._reply(500, str(e).encode(), 'text/plain')
+            self._reply(200, _encode(result.numpy()), 'application/octet-stream')
+
+        def log_message(self, format, *args):
+            pass
+
+    return _ThreadingHTTPServer((host, port), Handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SCPD purification server with dynamic batching.')
+    parser.add_argument('--dataset', default='cifar10', type=str, help='dataset = [cifar10/cifar100]')
+    parser.add_argument('--denoiser', default='', type=str,
+                        help='denoiser weights (default: ./checkpoint_denoise/denoiser/{dataset}_vgg_best.pth)')
+    parser.add_argument('--target', required=True, type=str, help='target model .t7 checkpoint')
+    parser.add_argument('--image_size', default=32, type=int, help='input height and width')
+    parser.add_argument('--host', default='127.0.0.1', type=str, help='address to listen on')
+    parser.add_argument('--port', default=8000, type=int, help='port to listen on')
+    parser.add_argument('--max_batch', default=64, type=int, help='images per micro-batch')
+    parser.add_argument('--max_latency_ms', default=5.0, type=float, help='longest wait for a batch to fill')
+    parser.add_argument('--precision', default='fp32', type=str, help='forward precision = [fp32/fp16/bf16]')
+    parser.add_argument('--channels_last', default=0, type=int, help='run the models in channels-last format')
+    args = parser.parse_args()
+    assert args.precision in MODES, 'Error: unknown precision {}'.format(args.precision)
+
+    use_cuda = torch.cuda.is_available()
+    denoiser_path = args.denoiser or './checkpoint_denoise/denoiser/{}_vgg_best.pth'.format(args.dataset)
+    denoiser, target_model = load_models(denoiser_path, args.target, use_cuda, args.image_size)
+    amp = Precision(args.precision, use_cuda=use_cuda, channels_last=bool(args.channels_last))
+    denoiser, target_model = amp.prepare_model(denoiser), amp.prepare_model(target_model)
+
+    with DynamicBatcher(denoiser, target_model, max_batch_size=args.max_batch, max_latency_ms=args.max_latency_ms,
+                        use_cuda=use_cuda, amp=amp) as batcher:
+        server = make_server(batcher, args.host, args.port)
+        print('serving on http://{}:{}'.format(args.host, args.port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Batching and error handling of the purification server, with slow stand-in networks on the CPU."""
+import io
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+# serving imports evaluation, which needs processor from the SCPD training code
+pytest.importorskip('processor')
+from serving import DynamicBatcher, make_server  # noqa: E402
+
+
+class SlowIdentity(nn.Module):
+    """Returns zeros after ``delay`` seconds, so ``x + denoiser(x)`` is ``x``."""
+
+    def __init__(self, delay):
+        super(SlowIdentity, self).__init__()
+        self.delay = delay
+
+    def forward(self, x):
+        time.sleep(self.delay)
+        return torch.zeros_like(x)
+
+
+class MeanTarget(nn.Module):
+    def forward(self, x):
+        return x.mean(dim=(2, 3))
+
+
+def test_backlog_runs_in_full_batches():
+    with DynamicBatcher(SlowIdentity(0.05), MeanTarget(), max_batch_size=32, max_latency_ms=1.0) as batcher:
+        images = [torch.rand(3, 8, 8) for _ in range(64)]
+        futures = [batcher.submit(x) for x in images]
+        results = [f.result() for f in futures]
+        stats = batcher.stats()
+    assert all(torch.allclose(r, x.mean(dim=(1, 2))) for r, x in zip(results, images))
+    # the first request may start a batch alone before the rest are queued; the backlog behind it must batch
+    assert stats['batches'] <= 3 and stats['mean_batch'] >= 64 / 3, stats
+
+
+def test_model_error_replies_500():
+    class SizeCheck(nn.Module):
+        def forward(self, x):
+            assert x.size(-1) == 8, 'expected 8x8 images, got {}'.format(tuple(x.shape[-2:]))
+            return x.mean(dim=(2, 3))
+
+    with DynamicBatcher(SlowIdentity(0.0), SizeCheck()) as batcher:
+        server = make_server(batcher, port=0)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            body = io.BytesIO()
+            np.save(body, np.zeros((16, 16, 3), dtype=np.uint8))
+            url = 'http://127.0.0.1:{}/classify'.format(server.server_address[1])
+            with pytest.raises(urllib.error.HTTPError) as e:
+                urllib.request.urlopen(urllib.request.Request(url, data=body.getvalue()), timeout=10)
+            assert e.value.code == 500 and b'expected 8x8 images' in e.value.read()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+def test_submit_after_close_raises():
+    batcher = DynamicBatcher(SlowIdentity(0.0), MeanTarget())
+    batcher.close()
+    with pytest.raises(RuntimeError):
+        batcher.submit(torch.rand(3, 8, 8))
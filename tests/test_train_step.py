@@ -0,0 +1,45 @@
+"""The fused and accumulated train steps must match the two-pass reference step.
+
+Uses the stand-in networks, so it runs on the CPU without data or checkpoints:
+
+    python -m pytest tests
+"""
+import functools
+
+import pytest
+import torch
+
+from benchmarks.stand_ins import StandInACT, build_models
+from train_step import STEP_TOLERANCE, accumulated_train_step, check_fused_step, fused_train_step
+
+STEPS = {'fused': fused_train_step, 'accumulated': functools.partial(accumulated_train_step, accum_steps=1)}
+
+
+@pytest.fixture(params=[0, 1, 2])
+def batch(request):
+    torch.manual_seed(request.param)
+    x = torch.rand(16, 3, 32, 32)
+    x_adv = (x + 0.03 * torch.randn_like(x)).clamp(0, 1)
+    return x, x_adv
+
+
+@pytest.mark.parametrize('name', sorted(STEPS))
+def test_matches_reference_step(name, batch):
+    denoiser, netD, target_model = build_models()
+    x, x_adv = batch
+    diffs = check_fused_step(denoiser, netD, target_model, torch.nn.BCEWithLogitsLoss(), StandInACT(target_model),
+                             x, x_adv, lr=1e-3, weight_decay=2e-4, weight_adv=5e-3, weight_act=1e3,
+                             step=STEPS[name])
+    assert set(diffs) == {'loss_D', 'loss', 'logits', 'denoiser', 'netD'}
+    for key, diff in diffs.items():
+        assert diff <= STEP_TOLERANCE, '{} step: {} differs by {:.3e}'.format(name, key, diff)
+
+
+def test_models_unchanged():
+    denoiser, netD, target_model = build_models()
+    before = [t.clone() for t in list(denoiser.state_dict().values()) + list(netD.state_dict().values())]
+    x = torch.rand(8, 3, 32, 32)
+    check_fused_step(denoiser, netD, target_model, torch.nn.BCEWithLogitsLoss(), StandInACT(target_model), x, x,
+                     lr=1e-3, weight_decay=2e-4, weight_adv=5e-3, weight_act=1e3)
+    after = list(denoiser.state_dict().values()) + list(netD.state_dict().values())
+    assert all(torch.equal(a, b) for a, b in zip(before, after))
@@ -0,0 +1,265 @@
+import copy
+
+import torch
+from torch import optim
+
+from precision import FP32
+from profiling import NULL_PROFILER
+
+
+def _relativistic_loss(bce, y_pred, y_pred_fake, t_first, t_second):
+    return (bce(y_pred - torch.mean(y_pred_fake), t_first) +
+            bce(y_pred_fake - torch.mean(y_pred), t_second)) / 2
+
+
+def reference_train_step(denoiser, netD, target_model, optimizer, optimizer_D, bce, act, x, x_adv, t_real, t_fake,
+                         weight_adv, weight_act, prof=NULL_PROFILER, amp=FP32):
+    """One SCPD iteration exactly as ``train()`` originally ran it, with two denoiser passes.
+
+    Returns:
+        (loss_D, loss, logits_smooth)
+    """
+    # train netD
+    with prof.phase('netD_update'):
+        with amp.autocast():
+            y_pred = netD(x)
+            noise = denoiser.forward(x_adv).detach()
+            x_smooth = x_adv + noise
+            y_pred_fake = netD(x_smooth)
+
+            loss_D = _relativistic_loss(bce, y_pred, y_pred_fake, t_real, t_fake)
+
+        optimizer_D.zero_grad()
+        amp.backward(loss_D)
+        amp.step(optimizer_D)
+
+    # Compute denoised image.
+    with prof.phase('denoiser_fwd'), amp.autocast():
+        noise = denoiser.forward(x_adv)
+        x_smooth = x_adv + noise
+
+    # adv_loss
+    with prof.phase('netD_adv'), amp.autocast():
+        y_pred = netD(x)
+        y_pred_fake = netD(x_smooth)
+
+        loss_adv = _relativistic_loss(bce, y_pred, y_pred_fake, t_fake, t_real) * weight_adv
+
+    # Get logits from smooth and denoised image
+    with prof.phase('target_fwd'), amp.autocast():
+        logits_smooth = target_model(x_smooth)
+
+    # Compute loss of logits
+    with prof.phase('act_loss'), amp.autocast():
+        loss_act = act(x_smooth, x) * weight_act
+
+    loss = loss_adv + loss_act
+
+    with prof.phase('denoiser_bwd'):
+        amp.backward(loss)
+        amp.step(optimizer)
+        optimizer.zero_grad()
+    amp.update()
+
+    return loss_D, loss, logits_smooth
+
+
+def fused_train_step(denoiser, netD, target_model, optimizer, optimizer_D, bce, act, x, x_adv, t_real, t_fake,
+                     weight_adv, weight_act, prof=NULL_PROFILER, amp=FP32):
+    """One SCPD iteration with a single denoiser pass.
+
+    The denoiser parameters do not change during the netD update, so its output is computed once and a
+    detached view feeds netD. netD has been stepped before the generator loss, so both of its outputs are
+    recomputed there; the real-image output only enters the generator loss as a constant, so it runs without
+    autograd, and netD's parameters are frozen so the generator backward stops at its input. The accuracy
+    logits are likewise computed without a graph.
+
+    Call ``fuse_bn_momentum(denoiser)`` once before using this step so BatchNorm running statistics follow
+    the same trajectory as the two-pass step.
+
+    Returns:
+        (loss_D, loss, logits_smooth)
+    """
+    with prof.phase('denoiser_fwd'), amp.autocast():
+        noise = denoiser.forward(x_adv)
+        x_smooth = x_adv + noise
+
+    # train netD
+    with prof.phase('netD_update'):
+        with amp.autocast():
+            y_pred = netD(x)
+            y_pred_fake = netD(x_smooth.detach())
+
+            loss_D = _relativistic_loss(bce, y_pred, y_pred_fake, t_real, t_fake)
+
+        optimizer_D.zero_grad()
+        amp.backward(loss_D)
+        amp.step(optimizer_D)
+
+    # adv_loss
+    params_D = [p for p in netD.parameters() if p.requires_grad]
+    for p in params_D:
+        p.requires_grad_(False)
+    try:
+        with prof.phase('netD_adv'), amp.autocast():
+            with torch.no_grad():
+                y_pred = netD(x)
+            y_pred_fake = netD(x_smooth)
+
+            loss_adv = _relativistic_loss(bce, y_pred, y_pred_fake, t_fake, t_real) * weight_adv
+
+        with prof.phase('target_fwd'), amp.autocast(), torch.no_grad():
+            logits_smooth = target_model(x_smooth)
+
+        with prof.phase('act_loss'), amp.autocast():
+            loss_act = act(x_smooth, x) * weight_act
+
+        loss = loss_adv + loss_act
+
+        with prof.phase('denoiser_bwd'):
+            amp.backward(loss)
+    finally:
+        for p in params_D:
+            p.requires_grad_(True)
+    with prof.phase('denoiser_bwd'):
+        amp.step(optimizer)
+        optimizer.zero_grad()
+    amp.update()
+
+    return loss_D, loss, logits_smooth
+
+
+def accumulated_train_step(denoiser, netD, target_model, optimizer, optimizer_D, bce, act, x, x_adv, t_real, t_fake,
+                           weight_adv, weight_act, prof=NULL_PROFILER, amp=FP32, accum_steps=1):
+    """One SCPD iteration over ``x`` split into ``accum_steps`` micro-batches, for batches that do not fit at once.
+
+    netD gradients are accumulated over every micro-batch and netD is stepped once; the denoiser gradients are
+    then accumulated against the updated netD and the denoiser is stepped once, the same order as the other steps.
+    Each micro-batch loss is weighted by its share of the images, so the update averages over the whole batch even
+    when the last micro-batch is smaller, but BatchNorm statistics and the relativistic means are those of the
+    micro-batch. Like the two-pass step the denoiser runs twice per micro-batch, the first time without autograd, so
+    BatchNorm momentum stays unfused.
+    The generator phase freezes netD and skips autograd where the fused step does.
+
+    Returns:
+        (loss_D, loss, logits_smooth), averaged or concatenated over the micro-batches and detached.
+    """
+    chunks = list(zip(x.chunk(accum_steps), x_adv.chunk(accum_steps), t_real.chunk(accum_steps),
+                      t_fake.chunk(accum_steps)))
+
+    # train netD
+    loss_D = 0
+    optimizer_D.zero_grad()
+    for x_m, x_adv_m, t_real_m, t_fake_m in chunks:
+        with prof.phase('netD_update'):
+            with amp.autocast():
+                with torch.no_grad():
+                    x_smooth = x_adv_m + denoiser.forward(x_adv_m)
+                y_pred = netD(x_m)
+                y_pred_fake = netD(x_smooth)
+
+                loss_m = _relativistic_loss(bce, y_pred, y_pred_fake, t_real_m, t_fake_m)
+                loss_m = loss_m * (x_m.size(0) / x.size(0))
+
+            amp.backward(loss_m)
+            loss_D = loss_D + loss_m.detach()
+    with prof.phase('netD_update'):
+        amp.step(optimizer_D)
+
+    loss = 0
+    logits = []
+    optimizer.zero_grad()
+    params_D = [p for p in netD.parameters() if p.requires_grad]
+    for p in params_D:
+        p.requires_grad_(False)
+    try:
+        for x_m, x_adv_m, t_real_m, t_fake_m in chunks:
+            with prof.phase('denoiser_fwd'), amp.autocast():
+                x_smooth = x_adv_m + denoiser.forward(x_adv_m)
+
+            # adv_loss
+            with prof.phase('netD_adv'), amp.autocast():
+                with torch.no_grad():
+                    y_pred = netD(x_m)
+                y_pred_fake = netD(x_smooth)
+
+                loss_adv = _relativistic_loss(bce, y_pred, y_pred_fake, t_fake_m, t_real_m) * weight_adv
+
+            with prof.phase('target_fwd'), amp.autocast(), torch.no_grad():
+                logits.append(target_model(x_smooth))
+
+            with prof.phase('act_loss'), amp.autocast():
+                loss_act = act(x_smooth, x_m) * weight_act
+
+            loss_m = (loss_adv + loss_act) * (x_m.size(0) / x.size(0))
+
+            with prof.phase('denoiser_bwd'):
+                amp.backward(loss_m)
+            loss = loss + loss_m.detach()
+    finally:
+        for p in params_D:
+            p.requires_grad_(True)
+    with prof.phase('denoiser_bwd'):
+        amp.step(optimizer)
+        optimizer.zero_grad()
+    amp.update()
+
+    return loss_D, loss, torch.cat(logits)
+
+
+def fuse_bn_momentum(module):
+    """Make one BatchNorm update equal to two updates with the same batch statistics.
+
+    The two-pass step feeds the same batch through the denoiser twice in train mode, so running statistics
+    move by ``1 - (1 - m) ** 2`` towards the batch statistics per iteration. Layers with cumulative averaging
+    (``momentum=None``) are left untouched.
+    """
+    for m in module.modules():
+        if isinstance(m, torch.nn.modules.batchnorm._BatchNorm) and m.momentum is not None:
+            m.momentum = 1 - (1 - m.momentum) ** 2
+    return module
+
+
+# largest difference from the two-pass step that --check_fused and the tests accept; fp32 rounding stays far below it
+STEP_TOLERANCE = 1e-5
+
+
+def check_fused_step(denoiser, netD, target_model, bce, act, x, x_adv, lr, weight_decay, weight_adv, weight_act,
+                     seed=0, step=fused_train_step):
+    """Run the two-pass step and ``step`` on copies of the models and compare them.
+
+    Both steps start from identical weights and fresh Adam optimizers. ``fused_train_step`` runs on a denoiser
+    with ``fuse_bn_momentum`` applied, as in training. The given models are not modified.
+
+    Returns:
+        dict mapping ``loss_D``, ``loss``, ``logits``, ``denoiser`` and ``netD`` to the maximum absolute
+        difference between the two steps (weights are compared after the update).
+    """
+    t_real = x.new_ones((x.size(0), 1))
+    t_fake = x.new_zeros((x.size(0), 1))
+
+    results = []
+    for candidate in (reference_train_step, step):
+        den, dis = copy.deepcopy(denoiser), copy.deepcopy(netD)
+        if candidate is fused_train_step:
+            fuse_bn_momentum(den)
+        den.train()
+        dis.train()
+        opt = optim.Adam(den.parameters(), lr=lr, weight_decay=weight_decay)
+        opt_D = optim.Adam(dis.parameters(), lr=lr, weight_decay=weight_decay)
+        torch.manual_seed(seed)
+        out = candidate(den, dis, target_model, opt, opt_D, bce, act, x, x_adv, t_real, t_fake, weight_adv,
+                        weight_act)
+        results.append((out, den, dis))
+
+    (ref_out, ref_den, ref_dis), (fused_out, fused_den, fused_dis) = results
+
+    def max_diff(a, b):
+        return max(((p - q).abs().max().item() for p, q in zip(a, b) if p.is_floating_point()),
+                   default=0.0)
+
+    return {'loss_D': (ref_out[0] - fused_out[0]).abs().item(),
+            'loss': (ref_out[1] - fused_out[1]).abs().item(),
+            'logits': (ref_out[2] - fused_out[2]).abs().max().item(),
+            'denoiser': max_diff(ref_den.state_dict().values(), fused_den.state_dict().values()),
+            'netD': max_diff(ref_dis.state_dict().values(), fused_dis.state_dict().values())}
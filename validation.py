@@ -0,0 +1,169 @@
+"""Validation scheduling: epoch stride, seeded test subsets with confidence intervals, and full evaluations of
+weight snapshots in worker processes while training continues.
+
+A worker is this module run as a script on one snapshot:
+
+    python -m validation --spec {out_dir}/spec.json --weights {out_dir}/e5.pth --epoch 5 --out {out_dir}/e5.json
+"""
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+from collections import deque
+
+import numpy as np
+import torch
+from torch.utils.data import Subset
+
+from checkpointing import to_cpu
+
+
+def should_validate(epoch, every, num_epochs):
+    """Validate every ``every`` epochs and always after the last one."""
+    return epoch % max(every, 1) == 0 or epoch == num_epochs
+
+
+def subset(dataset, size, seed=0):
+    """A fixed random ``size``-sample subset of ``dataset``, the same for every epoch and run with ``seed``."""
+    if not size or size >= len(dataset):
+        return dataset
+    indices = np.sort(np.random.RandomState(seed).choice(len(dataset), size, replace=False))
+    return Subset(dataset, indices.tolist())
+
+
+def wilson_interval(acc, n, z=1.96):
+    """Wilson score interval for an accuracy ``acc`` in percent measured on ``n`` images, in percent."""
+    if n == 0:
+        return 0.0, 100.0
+    p = acc / 100.0
+    denom = 1 + z ** 2 / n
+    center = (p + z ** 2 / (2 * n)) / denom
+    half = z * math.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) / denom
+    return 100.0 * max(center - half, 0.0), 100.0 * min(center + half, 1.0)
+
+
+class AsyncEvaluator(object):
+    """Evaluates denoiser snapshots on the full adversarial test set in separate worker processes.
+
+    ``submit`` queues a CPU copy of the weights for writing to ``out_dir/e{epoch}.pth`` through ``checkpointer``
+    and returns at once. ``poll`` starts workers for written snapshots, at most ``max_workers`` at a time, and
+    returns the results of those that finished, so training only pays for the snapshot copy. Each worker loads the
+    models and test data described by ``spec`` (see ``evaluate_snapshot``) and runs on its own GPU context.
+
+    Results are dicts with ``epoch``, ``adv_acc`` (``None`` if the worker failed), ``images``, ``seconds`` and
+    ``weights``, the snapshot path. Snapshots are left on disk for the caller to keep or remove.
+    """
+
+    def __init__(self, spec, out_dir, checkpointer, max_workers=1, env=None):
+        self.out_dir = out_dir
+        self.checkpointer = checkpointer
+        self.max_workers = max_workers
+        self.env = env
+        os.makedirs(out_dir, exist_ok=True)
+        self.spec_path = os.path.join(out_dir, 'spec.json')
+        with open(self.spec_path, 'w') as f:
+            json.dump(spec, f, indent=2)
+        self.pending = deque()
+        self.running = []
+
+    def submit(self, epoch, state_dict):
+        weights = os.path.join(self.out_dir, 'e{}.pth'.format(epoch))
+        self.checkpointer.save(to_cpu(state_dict), weights)
+        self.pending.append((epoch, weights))
+
+    def _launch(self):
+        while self.pending and len(self.running) < self.max_workers:
+            epoch, weights = self.pending[0]
+            if not os.path.exists(weights):  # still being written; os.replace makes it appear complete
+                break
+            self.pending.popleft()
+            out = os.path.join(self.out_dir, 'e{}.json'.format(epoch))
+            log = open(os.path.join(self.out_dir, 'e{}.log'.format(epoch)), 'w')
+            proc = subprocess.Popen([sys.executable, '-m', 'validation', '--spec', self.spec_path,
+                                     '--weights', weights, '--epoch', str(epoch), '--out', out],
+                                    stdout=log, stderr=subprocess.STDOUT, env=self.env)
+            self.running.append((epoch, weights, out, proc, log))
+
+    def poll(self):
+        """Start waiting workers and return the results of finished ones, oldest epoch first."""
+        results = []
+        for job in list(self.running):
+            epoch, weights, out, proc, log = job
+            if proc.poll() is None:
+                continue
+            log.close()
+            self.running.remove(job)
+            result = {'epoch': epoch, 'adv_acc': None, 'images': 0, 'seconds': 0.0, 'weights': weights}
+            if proc.returncode == 0 and os.path.isfile(out):
+                with open(out) as f:
+                    result.update(json.load(f))
+            results.append(result)
+        self._launch()
+        return sorted(results, key=lambda r: r['epoch'])
+
+    def close(self):
+        """Wait for every submitted snapshot to be evaluated and return the remaining results."""
+        self.checkpointer.wait()
+        results = []
+        while self.pending or self.running:
+            self._launch()
+            for job in self.running:
+                job[3].wait()
+            results += self.poll()
+        return sorted(results, key=lambda r: r['epoch'])
+
+
+def evaluate_snapshot(spec, weights):
+    """Full adversarial-set accuracy of the denoiser ``weights`` under ``spec``.
+
+    ``spec`` keys: ``target_path``, ``image_size``, ``batch_size``, ``packed``, ``cln_dirs``, ``adv_dirs``,
+    ``label_dirs`` (ignored for packed data), ``precision``, ``channels_last`` and ``use_cuda``.
+    """
+    from torch.utils.data import DataLoader
+    from torchvision import transforms
+
+    from dataload_packed import DatasetPacked_Dual, packed_loader
+    from evaluation import evaluate_loader
+    from precision import Precision
+    from serving import load_models
+
+    use_cuda = spec['use_cuda'] and torch.cuda.is_available()
+    denoiser, target_model = load_models(weights, spec['target_path'], use_cuda, spec['image_size'])
+    amp = Precision(spec['precision'], use_cuda=use_cuda, channels_last=spec['channels_last'])
+    denoiser, target_model = amp.prepare_model(denoiser), amp.prepare_model(target_model)
+
+    if spec['packed']:
+        data = DatasetPacked_Dual(cln_dirs=spec['cln_dirs'], adv_dirs=spec['adv_dirs'])
+        loader = packed_loader(data, batch_size=spec['batch_size'])
+    else:
+        from dataload import DatasetNPY_Dual
+
+        data = DatasetNPY_Dual(imgcln_dirs=spec['cln_dirs'], imgadv_dirs=spec['adv_dirs'],
+                               label_dirs=spec['label_dirs'], transform=transforms.ToTensor())
+        loader = DataLoader(data, batch_size=spec['batch_size'], shuffle=False)
+    return evaluate_loader(denoiser, target_model, loader, use_cuda, clean=False, amp=amp)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate one SCPD denoiser snapshot for AsyncEvaluator.')
+    parser.add_argument('--spec', required=True, type=str, help='JSON spec written by AsyncEvaluator')
+    parser.add_argument('--weights', required=True, type=str, help='denoiser snapshot')
+    parser.add_argument('--epoch', required=True, type=int, help='epoch the snapshot was taken after')
+    parser.add_argument('--out', required=True, type=str, help='JSON result file')
+    args = parser.parse_args()
+
+    with open(args.spec) as f:
+        spec = json.load(f)
+    result = evaluate_snapshot(spec, args.weights)
+    result = {'epoch': args.epoch, 'adv_acc': result['adv_acc'], 'images': result['images'],
+              'seconds': result['seconds']}
+    with open(args.out + '.tmp', 'w') as f:
+        json.dump(result, f)
+    os.replace(args.out + '.tmp', args.out)
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
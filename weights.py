@@ -0,0 +1,282 @@
+"""Weight-only checkpoints: the tensors of a state dict in one memory-mappable file, described by JSON metadata.
+
+A checkpoint is a directory, by default named like the file it was converted from with a ``.weights`` suffix:
+
+    tensors.bin   every tensor's raw bytes in native byte order, each at a 64-byte aligned offset
+    meta.json     architecture and its arguments, dataset, tensor names, dtypes, shapes and offsets, the
+                  sha256 of tensors.bin, and the size and mtime of the converted file
+
+Nothing is unpickled on load. ``load_module`` builds the network from the metadata, without allocating its initial
+weights where PyTorch allows, and hands it tensors that share the pages of a copy-on-write map of tensors.bin, so
+the file is only read as the weights are used and never copied into a second buffer. Convert the pickled checkpoints
+from the repository root:
+
+    python weights.py --src ./checkpoint/vgg-cifar10.t7 --net_type vgg --dataset cifar10
+    python weights.py --src ./checkpoint_denoise/denoiser/cifar10_vgg_best.pth --dataset cifar10
+"""
+import argparse
+import hashlib
+import importlib
+import inspect
+import itertools
+import json
+import logging
+import os
+import shutil
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from checkpointing import load_pickled, strip_prefix
+from distributed import unwrap
+from logit_cache import file_digest
+
+FORMAT_VERSION = 1
+EXTENSION = '.weights'
+TENSOR_FILE = 'tensors.bin'
+META_FILE = 'meta.json'
+ALIGN = 64
+# arguments of example_logits.getNetwork that decide the target architecture
+TARGET_ARGS = ('net_type', 'depth', 'widen_factor', 'dropout', 'dataset')
+
+_ASSIGN = 'assign' in inspect.signature(nn.Module.load_state_dict).parameters
+
+
+def _denoiser(image_size=32):
+    from networks.denoiser import Denoiser
+
+    return Denoiser(x_h=image_size, x_w=image_size)
+
+
+def _target(**kwargs):
+    from example_logits import getNetwork
+    from scpd import build_parser
+
+    # getNetwork reads a full command line namespace; the defaults stand in for what the metadata leaves out
+    args = build_parser().parse_args([])
+    vars(args).update(kwargs)
+    return getNetwork(args)[0]
+
+
+ARCHS = {'denoiser': _denoiser, 'target': _target}
+
+
+def class_name(module):
+    return '{}.{}'.format(type(module).__module__, type(module).__qualname__)
+
+
+def build_module(arch, arch_kwargs=None):
+    """Construct ``arch``: a name in ``ARCHS`` or the dotted path of an ``nn.Module`` class."""
+    arch_kwargs = arch_kwargs or {}
+    if arch in ARCHS:
+        return ARCHS[arch](**arch_kwargs)
+    module_name, _, name = arch.rpartition('.')
+    assert module_name, 'Error: unknown architecture {}, expected one of {} or a dotted class path'.format(
+        arch, tuple(ARCHS))
+    return getattr(importlib.import_module(module_name), name)(**arch_kwargs)
+
+
+def weights_path(path):
+    """Where the weight-only conversion of the checkpoint file ``path`` goes by default."""
+    return os.path.splitext(path)[0] + EXTENSION
+
+
+def is_weights(path):
+    return os.path.isfile(os.path.join(path, META_FILE))
+
+
+def source_stat(path):
+    """Size and modification time of a checkpoint file, which a conversion records to detect a rewritten source."""
+    st = os.stat(path)
+    return {'source_size': st.st_size, 'source_mtime_ns': st.st_mtime_ns}
+
+
+def prefer_weights(path):
+    """``path``, or its converted weight-only checkpoint if one exists next to it and was made from ``path`` as it
+    is now. A conversion whose source has been rewritten since is ignored with a warning."""
+    converted = weights_path(path)
+    if is_weights(path) or not is_weights(converted):
+        return path
+    if not os.path.isfile(path):
+        return converted
+    meta = read_meta(converted)
+    if any(meta.get(k) != v for k, v in source_stat(path).items()):
+        logging.warning('| Ignoring {}: {} changed after it was converted; rerun weights.py'.format(converted, path))
+        return path
+    return converted
+
+
+def read_meta(path):
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+    assert meta.get('format') == FORMAT_VERSION, 'Error: {} has weight format {}, expected {}'.format(
+        path, meta.get('format'), FORMAT_VERSION)
+    return meta
+
+
+def save_weights(state_dict, path, arch, arch_kwargs=None, **meta):
+    """Write ``state_dict`` as a weight-only checkpoint directory.
+
+    ``DataParallel`` prefixes are dropped, so the names match the bare network ``arch`` builds. The directory is
+    written under ``path + '.tmp'`` and renamed into place. Extra keyword arguments (``dataset``, ``class``, ...)
+    are stored in the metadata.
+
+    Returns:
+        the metadata.
+    """
+    tmp = path + '.tmp'
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    tensors = OrderedDict()
+    h = hashlib.sha256()
+    offset = 0
+    with open(os.path.join(tmp, TENSOR_FILE), 'wb') as f:
+        for name, t in strip_prefix(state_dict).items():
+            data = t.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy()
+            pad = bytes(-offset % ALIGN)
+            f.write(pad)
+            h.update(pad)
+            offset += len(pad)
+            tensors[name] = {'dtype': str(t.dtype).replace('torch.', ''), 'shape': list(t.shape), 'offset': offset,
+                             'nbytes': data.nbytes}
+            f.write(data)
+            h.update(data)
+            offset += data.nbytes
+
+    meta = dict(meta, format=FORMAT_VERSION, arch=arch, arch_kwargs=arch_kwargs or {}, size=offset,
+                sha256=h.hexdigest(), tensors=tensors)
+    with open(os.path.join(tmp, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+    return meta
+
+
+def load_state(path, verify=False):
+    """State dict of a weight-only checkpoint whose tensors share the pages of a copy-on-write map of its file.
+
+    Writing to a tensor copies only the pages it touches and never changes the file. ``verify`` checks the sha256
+    first, which reads the whole file.
+    """
+    meta = read_meta(path)
+    blob_path = os.path.join(path, TENSOR_FILE)
+    if verify:
+        assert file_digest(blob_path) == meta['sha256'], 'Error: checksum mismatch in {}'.format(blob_path)
+    blob = np.memmap(blob_path, dtype=np.uint8, mode='c') if meta['size'] else np.zeros(0, dtype=np.uint8)
+    state = OrderedDict()
+    for name, t in meta['tensors'].items():
+        raw = torch.from_numpy(blob[t['offset']:t['offset'] + t['nbytes']])
+        state[name] = raw.view(getattr(torch, t['dtype'])).view(t['shape'])
+    return state
+
+
+def _load(module, state):
+    if _ASSIGN:
+        module.load_state_dict(state, assign=True)
+    else:
+        module.load_state_dict(state)
+    return module
+
+
+def load_module(path, verify=False):
+    """Build the network a weight-only checkpoint describes and load its weights, in eval mode on the CPU.
+
+    With PyTorch 2.1 or newer the network is constructed on the meta device and takes the mapped tensors as its
+    parameters, so neither its initial weights nor a second copy of the checkpoint are ever allocated. Networks
+    that keep tensors outside their state dict are constructed normally instead.
+    """
+    meta = read_meta(path)
+    state = load_state(path, verify=verify)
+    module = None
+    if _ASSIGN and hasattr(torch.device, '__enter__'):
+        try:
+            with torch.device('meta'):
+                module = build_module(meta['arch'], meta['arch_kwargs'])
+        except (NotImplementedError, RuntimeError):  # constructors that compute on their tensors
+            module = None
+        if module is not None:
+            _load(module, state)
+            if any(t.is_meta for t in itertools.chain(module.parameters(), module.buffers())):
+                module = None
+    if module is None:
+        module = _load(build_module(meta['arch'], meta['arch_kwargs']), state)
+    assert meta.get('class') in (None, class_name(module)), 'Error: {} was saved from {} but builds {}'.format(
+        path, meta['class'], class_name(module))
+    return module.eval()
+
+
+def load_target(path):
+    """The target network of a weight-only checkpoint or of a pickled ``.t7`` file, unwrapped, on the CPU."""
+    if is_weights(path):
+        return load_module(path)
+    return unwrap(load_pickled(path)['net'])
+
+
+def load_denoiser_state(path):
+    """Denoiser state dict without ``DataParallel`` prefixes from a weight-only checkpoint or a ``.pth`` file."""
+    if is_weights(path):
+        return load_state(path)
+    return strip_prefix(torch.load(path, map_location='cpu'))
+
+
+def checkpoint_state(obj):
+    """State dict and network class of a loaded pickled checkpoint: a ``.t7`` dict with the whole network under
+    ``net``, a ``training_state`` (its denoiser) or a plain state dict. The class is ``None`` unless pickled."""
+    if isinstance(obj, dict) and isinstance(obj.get('net'), nn.Module):
+        net = unwrap(obj['net'])
+        return net.state_dict(), class_name(net)
+    if isinstance(obj, dict) and 'denoiser' in obj:
+        return obj['denoiser'], None
+    return obj, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert pickled SCPD checkpoints to weight-only checkpoints.')
+    parser.add_argument('--src', required=True, type=str, help='.t7 target model or .pth denoiser checkpoint')
+    parser.add_argument('--out', default='', type=str, help='output directory (default: src with a .weights suffix)')
+    parser.add_argument('--arch', default='', type=str,
+                        help='target, denoiser or a dotted nn.Module class (default: from the checkpoint)')
+    parser.add_argument('--arch_kwargs', default='', type=str, help='JSON constructor arguments of a class --arch')
+    parser.add_argument('--net_type', default='vgg', type=str, help='target model, as in main.py')
+    parser.add_argument('--depth', default=28, type=int, help='depth of the target model')
+    parser.add_argument('--widen_factor', default=10, type=int, help='width of the target model')
+    parser.add_argument('--dropout', default=0.3, type=float, help='dropout rate of the target model')
+    parser.add_argument('--dataset', default='cifar10', type=str, help='dataset = [cifar10/cifar100/svhn]')
+    parser.add_argument('--image_size', default=32, type=int, help='input height and width of the denoiser')
+    parser.add_argument('--check', default=1, type=int, help='rebuild the network from the output and compare')
+    args = parser.parse_args()
+
+    # taken before reading, so a source rewritten during the conversion no longer matches it
+    stat = source_stat(args.src)
+    state, cls = checkpoint_state(load_pickled(args.src))
+    state = strip_prefix(state)
+    arch = args.arch or ('target' if cls else 'denoiser')
+    if args.arch_kwargs:
+        arch_kwargs = json.loads(args.arch_kwargs)
+    elif arch == 'target':
+        arch_kwargs = {k: getattr(args, k) for k in TARGET_ARGS}
+    elif arch == 'denoiser':
+        arch_kwargs = {'image_size': args.image_size}
+    else:
+        arch_kwargs = {}
+    meta = dict(stat, **({'class': cls} if cls else {}))
+
+    out = args.out or weights_path(args.src)
+    meta = save_weights(state, out, arch, arch_kwargs, dataset=args.dataset, source=os.path.basename(args.src),
+                        **meta)
+    print('converted {} to {}: {} tensors, {:.1f}MB, sha256 {}'.format(
+        args.src, out, len(meta['tensors']), meta['size'] / 2 ** 20, meta['sha256'][:16]))
+    if args.check:
+        loaded = load_module(out, verify=True).state_dict()
+        assert list(loaded) == list(state) and all(torch.equal(loaded[k], state[k].cpu()) for k in loaded), \
+            'Error: {} does not rebuild the weights of {}'.format(out, args.src)
+        print('rebuilt {} from {} and checked every tensor'.format(arch, out))
+
+
+if __name__ == '__main__':
+    main()